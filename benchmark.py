@@ -0,0 +1,138 @@
+import contextlib
+import io
+import json
+import subprocess
+import time
+from datetime import datetime, timezone
+from utils import configure_log, feature_connections
+from graph_snapshot import GraphSnapshot, SAMPLE_LABEL
+from synthetic_graph import generate_snapshot
+from cohort_index import CohortIndex
+from feature_matrix import get_disease_feature_matrices
+from comparison import compare_to_control
+from sample_similarity import SimilarityIndex
+import graph_structure
+import disease_analysis
+
+
+BENCHMARK_FOLDER = "./benchmark"
+BENCHMARK_FILE = "./benchmark_results.jsonl"
+BENCHMARK_SCALES = [1000, 10000, 100000]
+
+
+@contextlib.contextmanager
+def timed(timings, name):
+    # the analysis functions print a lot, which would dominate small scales
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+    timings[name] = time.perf_counter() - start
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_snapshot(snapshot, diseases=20, control_name="control"):
+    timings = {}
+    relationships = [(SAMPLE_LABEL, rel, label) for rel, label in snapshot.connections]
+
+    with timed(timings, "overview"):
+        graph_structure.get_all_node_counts(
+            [SAMPLE_LABEL] + [label for _, label in snapshot.connections], snapshot
+        )
+        graph_structure.get_all_rel_min_max_avg(relationships, snapshot, batched=True, histogram=True)
+        disease_counts = graph_structure.get_disease_counts(snapshot, min_occurrence=1, log=True)
+        graph_structure.get_people_analysis(snapshot)
+
+    disease_names = list(disease_counts.keys())[:diseases]
+    with timed(timings, "extraction_queries"):
+        control_groups = disease_analysis.get_common_groups(
+            feature_connections, control_name, snapshot
+        )
+        disease_groups = {
+            name: disease_analysis.get_common_groups(feature_connections, name, snapshot)
+            for name in disease_names
+        }
+
+    with timed(timings, "index_build"):
+        cohort_index = CohortIndex(snapshot)
+    with timed(timings, "extraction_index"):
+        for name in [control_name] + disease_names:
+            disease_analysis.get_common_groups(
+                feature_connections, name, snapshot, cohort_index=cohort_index
+            )
+
+    control_count = disease_analysis.get_number_of_occurences(control_name, snapshot)
+    with timed(timings, "comparison"):
+        for name, groups in disease_groups.items():
+            for control, disease in zip(control_groups, groups):
+                node_type = list(control.keys())[0]
+                disease_analysis.compare_common_group_for_disease(
+                    common_group_disease=disease[node_type],
+                    common_group_control=control[node_type],
+                    total_disease_count=disease_counts[name],
+                    total_control_count=control_count,
+                    node_type=node_type,
+                )
+
+    with timed(timings, "comparison_matrix"):
+        matrices = get_disease_feature_matrices(snapshot)
+        for matrix in matrices.values():
+            compare_to_control(matrix, control_name)
+
+    with timed(timings, "similarity_index"):
+        similarity_index = SimilarityIndex(snapshot)
+        similarity_index.add_disease_profiles(cohort_index)
+    with timed(timings, "similarity_queries"):
+        for sample in range(0, snapshot.sample_count, max(1, snapshot.sample_count // 100)):
+            similarity_index.get_similar_samples(sample)
+        for name in disease_names:
+            similarity_index.get_similar_diseases(name)
+    return timings
+
+
+def run_benchmark(
+    scales=BENCHMARK_SCALES,
+    path=BENCHMARK_FOLDER,
+    results_file=BENCHMARK_FILE,
+    diseases=20,
+    skew=1.0,
+    seed=0,
+):
+    # Times the overview, per-disease extraction and comparison paths on
+    # synthetic graphs of every scale and appends one JSON line per scale to
+    # results_file for regression tracking.
+    configure_log(echo=False, path=f"{path}_log.txt", json_path=f"{path}_log.jsonl")
+    commit = get_commit()
+    results = []
+    for samples in scales:
+        snapshot_path = f"{path}/{samples}"
+        start = time.perf_counter()
+        generate_snapshot(snapshot_path, samples=samples, skew=skew, seed=seed)
+        generate_time = time.perf_counter() - start
+        timings = benchmark_snapshot(GraphSnapshot(snapshot_path), diseases)
+        result = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "commit": commit,
+            "samples": samples,
+            "skew": skew,
+            "seed": seed,
+            "diseases": diseases,
+            "generate": generate_time,
+            "timings": timings,
+        }
+        print(f"{samples} samples: " + ", ".join(f"{k}: {v:.2f}s" for k, v in timings.items()))
+        with open(results_file, "a") as f:
+            f.write(json.dumps(result) + "\n")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark()
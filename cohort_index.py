@@ -0,0 +1,185 @@
+import json
+import os
+import numpy as np
+from pyroaring import BitMap
+from scipy import sparse
+from graph_snapshot import GraphSnapshot, export_snapshot, SNAPSHOT_CONNECTIONS
+
+
+INDEX_FOLDER = "./cohort_index"
+
+
+class CohortIndex:
+    # In-process replacement for the per-disease cohort queries
+    # (number_of_occurrences, total_association_count_for_disease and
+    # type_occurrence_for_disease): one bitset of sample indices per disease
+    # name on top of the sample -> feature CSR arrays of a GraphSnapshot.
+    def __init__(self, snapshot, path=None):
+        self.snapshot = snapshot
+        self.path = path
+        if path is not None and os.path.exists(f"{path}/cohorts.npy"):
+            self.cohorts = np.load(f"{path}/cohorts.npy", mmap_mode="r")
+            with open(f"{path}/cohorts.json", "r") as f:
+                index = json.load(f)
+            self.disease_names = index["diseases"]
+            self.disease_counts = np.asarray(index["disease_counts"], dtype=np.int64)
+        else:
+            self._build()
+            if path is not None:
+                self.save()
+        self.disease_index = {name: i for i, name in enumerate(self.disease_names)}
+        self._cohorts = {}
+
+    def _build(self):
+        snapshot = self.snapshot
+        node_names = snapshot.names["Disease"]
+        self.disease_names = sorted(set(node_names) - {None})
+        name_index = {name: i for i, name in enumerate(self.disease_names)}
+        # edges to nameless diseases map to -1 and are dropped
+        node_to_name = np.array([name_index.get(name, -1) for name in node_names], dtype=np.int64)
+        edge_diseases = node_to_name[snapshot.indices["HAS_DISEASE"]]
+        edge_samples = snapshot.get_edge_samples("HAS_DISEASE")
+        keep = edge_diseases >= 0
+        edge_diseases = edge_diseases[keep]
+        edge_samples = edge_samples[keep]
+        # count(r) of HAS_DISEASE per disease name, like disease_count_by_name
+        self.disease_counts = np.bincount(edge_diseases, minlength=len(self.disease_names))
+        # bits are set in place, in np.packbits order, without a dense
+        # diseases x samples mask
+        self.cohorts = np.zeros(
+            (len(self.disease_names), (snapshot.sample_count + 7) // 8), dtype=np.uint8
+        )
+        np.bitwise_or.at(
+            self.cohorts,
+            (edge_diseases, edge_samples >> 3),
+            (np.uint8(128) >> (edge_samples & 7)).astype(np.uint8),
+        )
+
+    def save(self):
+        np.save(f"{self.path}/cohorts.npy", np.asarray(self.cohorts))
+        with open(f"{self.path}/cohorts.json", "w") as f:
+            json.dump(
+                {"diseases": self.disease_names, "disease_counts": self.disease_counts.tolist()}, f
+            )
+
+    def get_sample_mask(self, disease_name):
+        i = self.disease_index.get(disease_name)
+        if i is None:
+            return np.zeros(self.snapshot.sample_count, dtype=bool)
+        mask = np.unpackbits(self.cohorts[i], count=self.snapshot.sample_count)
+        return mask.astype(bool)
+
+    def get_samples(self, disease_name):
+        return np.flatnonzero(self.get_sample_mask(disease_name))
+
+    def get_membership(self, disease_names):
+        # sparse samples x diseases matrix, 1 where the sample has the disease
+        columns = [self.get_samples(name) for name in disease_names]
+        samples = np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64)
+        diseases = np.repeat(np.arange(len(columns)), [len(c) for c in columns])
+        return sparse.csr_matrix(
+            (np.ones(len(samples), dtype=np.float32), (samples, diseases)),
+            shape=(self.snapshot.sample_count, len(columns)),
+        )
+
+    def get_cohort(self, disease_name):
+        if disease_name not in self._cohorts:
+            samples = BitMap(self.get_samples(disease_name).astype(np.uint32))
+            self._cohorts[disease_name] = Cohort(self, samples, disease_name)
+        return self._cohorts[disease_name]
+
+    def get_disease_count(self, disease_name):
+        i = self.disease_index.get(disease_name)
+        return 0 if i is None else int(self.disease_counts[i])
+
+    def get_occurrences(self, disease_name, relationship_type):
+        # number of relationship_type edges from the cohort to every node
+        return self.get_sample_occurrences(self.get_samples(disease_name), relationship_type)
+
+    def get_sample_occurrences(self, samples, relationship_type):
+        matrix = self.snapshot.get_matrix(relationship_type)
+        cohort = matrix[samples]
+        return np.bincount(cohort.indices, weights=cohort.data, minlength=matrix.shape[1]).astype(
+            np.int64
+        )
+
+    def get_common_group(self, disease_name, node_type, relationship_type):
+        # common group and total association count of one disease, as
+        # returned by disease_analysis.analyze_common_group_for_disease
+        return self.get_sample_common_group(
+            self.get_samples(disease_name), node_type, relationship_type
+        )
+
+    def get_sample_common_group(self, samples, node_type, relationship_type):
+        self.snapshot.check_relationship(relationship_type, node_type)
+        occurrences = self.get_sample_occurrences(samples, relationship_type)
+        features = np.flatnonzero(occurrences)
+        names = self.snapshot.names[node_type]
+        common_group = {}
+        for j in features:
+            # nodes without a name are skipped and nodes sharing a name
+            # collapse, like in get_type_occurrence_for_disease
+            if names[j] is None:
+                continue
+            common_group[names[j]] = int(occurrences[j])
+        return common_group, len(features)
+
+
+class Cohort:
+    # Set of Biological_sample indices of a CohortIndex as a roaring bitmap.
+    # Cohorts combine with | (union), & (intersection) and - (difference),
+    # e.g. index.get_cohort("A") - index.get_cohort("B") for "A and not B".
+    def __init__(self, index, samples, name):
+        self.index = index
+        self.samples = samples
+        self.name = name
+
+    def __or__(self, other):
+        return Cohort(self.index, self.samples | other.samples, f"({self.name} | {other.name})")
+
+    def __and__(self, other):
+        return Cohort(self.index, self.samples & other.samples, f"({self.name} & {other.name})")
+
+    def __sub__(self, other):
+        return Cohort(self.index, self.samples - other.samples, f"({self.name} - {other.name})")
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        return f"Cohort({self.name}, {len(self)} samples)"
+
+    def get_sample_indices(self):
+        return np.frombuffer(self.samples.to_array(), dtype=np.uint32)
+
+    def get_common_group(self, node_type, relationship_type):
+        return self.index.get_sample_common_group(
+            self.get_sample_indices(), node_type, relationship_type
+        )
+
+    def get_common_groups(self, connections):
+        # Same shape as disease_analysis.get_common_groups
+        return [
+            {node_type: self.get_common_group(node_type, relationship_type)[0]}
+            for relationship_type, node_type in connections
+        ]
+
+
+def get_overlap_matrix(index, disease_names=None):
+    # overlap[i, j] is the number of samples with both disease i and j
+    if disease_names is None:
+        disease_names = index.disease_names
+    cohorts = [index.get_cohort(name).samples for name in disease_names]
+    overlap = np.zeros((len(cohorts), len(cohorts)), dtype=np.int64)
+    for i, a in enumerate(cohorts):
+        overlap[i, i] = len(a)
+        for j in range(i + 1, len(cohorts)):
+            overlap[i, j] = overlap[j, i] = a.intersection_cardinality(cohorts[j])
+    return disease_names, overlap
+
+
+def build_cohort_index(driver=None, path=INDEX_FOLDER, connections=SNAPSHOT_CONNECTIONS):
+    # Exports the snapshot on first use; later runs only load it.
+    if not os.path.exists(f"{path}/meta.json"):
+        export_snapshot(driver, path, connections)
+    return CohortIndex(GraphSnapshot(path), path)
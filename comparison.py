@@ -0,0 +1,94 @@
+import numpy as np
+from scipy import sparse
+from utils import percentage_sections
+
+
+SECTIONS = np.asarray(percentage_sections, dtype=float)
+
+
+def get_percentage_matrix(matrix):
+    # counts scaled by the number of samples of each disease
+    scale = sparse.diags(1.0 / np.maximum(matrix.disease_counts, 1))
+    return (scale @ matrix.counts).tocsr()
+
+
+def get_section_indices(percentage_diff):
+    # Index into percentage_sections of the section a difference falls in,
+    # i.e. last_section < diff <= section as in
+    # disease_analysis.count_percentage_diff_in_sections. Values outside
+    # (-1, 1] get -1.
+    indices = np.searchsorted(SECTIONS, percentage_diff, side="left")
+    indices[(indices == 0) | (indices == len(SECTIONS))] = -1
+    return indices
+
+
+def count_in_sections(percentage_diff):
+    indices = get_section_indices(np.asarray(percentage_diff, dtype=float))
+    return np.bincount(indices[indices >= 0], minlength=len(SECTIONS))
+
+
+def section_count_map(section_counts):
+    return {section: int(count) for section, count in zip(percentage_sections, section_counts)}
+
+
+def compare_to_control(
+    matrix,
+    control_name="control",
+    disease_names=None,
+    chunk_size=256,
+    return_diff=False,
+):
+    # Compares every disease in disease_names (default: all but the control)
+    # against the control in chunks of dense rows. Only features seen in the
+    # disease or in the control count, like the key union in
+    # compare_common_group_for_disease. The returned sparse differences do
+    # not store features whose difference is exactly 0.
+    if disease_names is None:
+        disease_names = [name for name in matrix.diseases if name != control_name]
+    disease_index = {name: i for i, name in enumerate(matrix.diseases)}
+    rows = np.array([disease_index[name] for name in disease_names], dtype=np.int64)
+
+    percentages = get_percentage_matrix(matrix)
+    control_row = disease_index[control_name]
+    control_percentage = percentages.getrow(control_row).toarray().ravel()
+    control_seen = matrix.counts.getrow(control_row).toarray().ravel() > 0
+
+    section_counts = np.zeros((len(rows), len(SECTIONS)), dtype=np.int64)
+    diffs = []
+    for chunk_start in range(0, len(rows), chunk_size):
+        chunk = rows[chunk_start : chunk_start + chunk_size]
+        disease_percentage = percentages[chunk].toarray()
+        seen = (matrix.counts[chunk].toarray() > 0) | control_seen
+        diff = disease_percentage - control_percentage
+
+        indices = get_section_indices(diff)
+        valid = seen & (indices >= 0)
+        row_offsets = np.nonzero(valid)[0] * len(SECTIONS)
+        section_counts[chunk_start : chunk_start + len(chunk)] = np.bincount(
+            row_offsets + indices[valid], minlength=len(chunk) * len(SECTIONS)
+        ).reshape(len(chunk), len(SECTIONS))
+        if return_diff:
+            diffs.append(sparse.csr_matrix(np.where(seen, diff, 0.0)))
+
+    if return_diff:
+        return disease_names, section_counts, sparse.vstack(diffs).tocsr()
+    return disease_names, section_counts
+
+
+def percentage_diff_to_dict(matrix, disease_name, control_name="control"):
+    # dict output of compare_common_group_for_disease for a single disease,
+    # used for plotting
+    disease_index = {name: i for i, name in enumerate(matrix.diseases)}
+    percentages = get_percentage_matrix(matrix)
+    disease_row = percentages.getrow(disease_index[disease_name])
+    control_row = percentages.getrow(disease_index[control_name])
+    percentage_map_disease = {
+        matrix.features[j]: value for j, value in zip(disease_row.indices, disease_row.data)
+    }
+    percentage_map_control = {
+        matrix.features[j]: value for j, value in zip(control_row.indices, control_row.data)
+    }
+    seen = np.union1d(disease_row.indices, control_row.indices)
+    diff = (disease_row - control_row).toarray().ravel()[seen]
+    percentage_diff = {matrix.features[j]: value for j, value in zip(seen, diff)}
+    return percentage_diff, percentage_map_disease, percentage_map_control
@@ -1,21 +1,37 @@
 # %%
 import matplotlib.pyplot as plt
 import math
+import multiprocessing
 from random import randrange
 from utils import (
-    request,
     log_to_file,
     clear_log_file,
     save_feature_analysis_to_file,
     percentage_sections,
+    feature_connections,
 )
 import utils
-from neo4j import GraphDatabase
+from session_manager import SessionManager
+from query_cache import QueryCache
 import graph_structure
+from profiler import profiled, start_profiling, stop_profiling
+from queries import run_query, stream_query
 import os
-from plot_util import plot_common_group_for_disease, plot_common_group_comparison, plot_occ_diff_count
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from comparison import count_in_sections, section_count_map
+from feature_matrix import get_disease_feature_matrices
+from significance import test_against_control, count_significant
+from permutation import permutation_test
+from plot_util import (
+    plot_common_group_for_disease,
+    plot_common_group_comparison,
+    plot_occ_diff_count,
+    set_batch_mode,
+)
 
 
+@profiled
 def analyze_common_group_for_disease(
     disease_count,
     disease_name,
@@ -24,13 +40,20 @@ def analyze_common_group_for_disease(
     relationship_type,
     plot=False,
     save_analysis=False,
+    feature_writer=None,
+    cohort_index=None,
 ):
-    total_association = get_total_association_count_for_disease(
-        disease_name, driver, node_type, relationship_type
-    )
-    common_group = get_type_occurrence_for_disease(
-        disease_count, disease_name, driver, node_type, relationship_type
-    )
+    if cohort_index is not None:
+        common_group, total_association = cohort_index.get_common_group(
+            disease_name, node_type, relationship_type
+        )
+    else:
+        total_association = get_total_association_count_for_disease(
+            disease_name, driver, node_type, relationship_type
+        )
+        common_group = get_type_occurrence_for_disease(
+            disease_count, disease_name, driver, node_type, relationship_type
+        )
     if save_analysis:
         save_feature_analysis_to_file(
             disease_name,
@@ -40,6 +63,15 @@ def analyze_common_group_for_disease(
             node_type,
             relationship_type,
         )
+    if feature_writer is not None:
+        feature_writer.add(
+            disease_name,
+            common_group,
+            total_association,
+            disease_count,
+            node_type,
+            relationship_type,
+        )
     if plot:
         plot_common_group_for_disease(
             common_group, disease_name, total_association, disease_count, node_type
@@ -47,15 +79,17 @@ def analyze_common_group_for_disease(
     return common_group, total_association
 
 
+@profiled
 def get_total_association_count_for_disease(
     disease_name, driver, node_type, relationship_type
 ):
-    query = f"""
-    MATCH (d:Disease {{name:\"{disease_name}\"}})<-[:HAS_DISEASE]-(s:Biological_sample)-[:{relationship_type}]->(n:{node_type})
-    RETURN d.name AS Disease, count(DISTINCT n) AS total_associations
-    ORDER BY total_associations DESC
-    """
-    total_associations_result = request(driver, query)
+    total_associations_result = run_query(
+        driver,
+        "total_association_count_for_disease",
+        {"name": disease_name},
+        node_type=node_type,
+        relationship_type=relationship_type,
+    )
     if len(total_associations_result) == 0:
         print(
             f"No associations found for {disease_name} and {node_type} and {relationship_type}"
@@ -65,18 +99,17 @@ def get_total_association_count_for_disease(
     return total_association
 
 
+@profiled
 def get_type_occurrence_for_disease(
     disease_count, disease_name, driver, node_type, relationship_type
 ):
-
-    query = f"""
-    MATCH (d:Disease {{name:\"{disease_name}\"}})<-[:HAS_DISEASE]-(s:Biological_sample)-[r:{relationship_type}]->(n:{node_type})
-    WITH count(DISTINCT r) AS samples_with_node, n AS n
-    RETURN n.name AS node_name, samples_with_node
-    """
-    all_common_group_result = request(driver, query)
-    if len(all_common_group_result) == 0:
-        return {}
+    all_common_group_result = stream_query(
+        driver,
+        "type_occurrence_for_disease",
+        {"name": disease_name},
+        node_type=node_type,
+        relationship_type=relationship_type,
+    )
     common_group = {}
     for sample in all_common_group_result:
         if sample["node_name"] is None:
@@ -86,6 +119,7 @@ def get_type_occurrence_for_disease(
     return common_group
 
 
+@profiled
 def compare_common_group_for_disease(
     common_group_disease=None,
     common_group_control=None,
@@ -129,34 +163,18 @@ def compare_common_group_for_disease(
 
 
 def count_percentage_diff_in_sections(percentage_diff):
-    section_map = {section: 0 for section in percentage_sections}
-
-    for node, percentage in percentage_diff.items():
-        last_section = -1
-        for section in percentage_sections:
-            if percentage > last_section and percentage <= section:
-                section_map[section] += 1
-                last_section = section
-                break
-
-    return section_map
+    return section_count_map(count_in_sections(list(percentage_diff.values())))
 
 
 def get_all_control_disease_comparisons(control_name, driver, occurrences=5):
-    connections = [
-        ("HAS_PHENOTYPE", "Phenotype"),
-        ("HAS_DAMAGE", "Gene"),
-        ("HAS_PROTEIN", "Protein"),
-    ]
-    
+    connections = feature_connections
+
     control_occurences = get_number_of_occurences(control_name, driver)
     control_common_groups = get_common_groups(connections, control_name, driver)
 
-    query = f"""Match (d:Disease)<-[:HAS_DISEASE]-(s:Biological_sample)
-                with d, count(s) as count
-                where count <= {occurrences}
-                return d.name as name, count order by count desc"""
-    diseases = request(driver, query)
+    diseases = run_query(
+        driver, "diseases_with_max_occurrences", {"occurrences": occurrences}
+    )
     for disease in diseases:
         get_control_disease_comparison(
             connections,
@@ -169,21 +187,40 @@ def get_all_control_disease_comparisons(control_name, driver, occurrences=5):
         break
 
 
-def get_number_of_occurences( control_name, driver):
-    query = f"""Match (d:Disease {{name:\"{control_name}\"}})<-[:HAS_DISEASE]-(s:Biological_sample)
-                return count(s) as count"""
-    res = request(driver, query)
+@profiled
+def get_number_of_occurences( control_name, driver, cohort_index=None):
+    if cohort_index is not None:
+        return cohort_index.get_disease_count(control_name)
+    res = run_query(driver, "number_of_occurrences", {"name": control_name})
     if len(res) == 0:
         print(f"No occurences found for {control_name}")
         return 0
     return res[0]["count"]
 
+@profiled
 def get_control_disease_comparison(
     connections, disease_name, driver, control_occurences=None, disease_occurences=None, control_common_groups=None
 ):
     
     disease_common_groups = get_common_groups(connections, disease_name, driver)
+    return compare_control_disease_common_groups(
+        disease_name,
+        disease_common_groups,
+        control_common_groups,
+        control_occurences,
+        disease_occurences,
+    )
 
+
+@profiled
+def compare_control_disease_common_groups(
+    disease_name,
+    disease_common_groups,
+    control_common_groups,
+    control_occurences,
+    disease_occurences,
+):
+    section_count_maps = {}
     for control, disease in zip(control_common_groups, disease_common_groups):
         control_key = list(control.keys())[0]
         disease_key = list(disease.keys())[0]
@@ -208,12 +245,201 @@ def get_control_disease_comparison(
             control_key,
             save_plot=True,
         )
+        section_count_maps[control_key] = section_count_map
+    return section_count_maps
+
+
+def compare_cohorts(cohort, control_cohort, connections=feature_connections, plot=False):
+    # cohort and control_cohort are cohort_index.Cohort objects, e.g.
+    # index.get_cohort("A") - index.get_cohort("B"); percentages are relative
+    # to the number of samples in each cohort.
+    section_count_maps = {}
+    for relationship_type, node_type in connections:
+        _, section_count_map = compare_common_group_for_disease(
+            common_group_disease=cohort.get_common_group(node_type, relationship_type)[0],
+            common_group_control=control_cohort.get_common_group(node_type, relationship_type)[0],
+            total_disease_count=len(cohort),
+            total_control_count=len(control_cohort),
+            node_type=node_type,
+            plot=plot,
+            save_plot=plot,
+            disease_name=cohort.name,
+        )
+        section_count_maps[node_type] = section_count_map
+    return section_count_maps
 
 
-def get_common_groups(connections, disease_name, driver):
-    disease_count = graph_structure.get_disease_counts(driver, name=disease_name)[
-        disease_name
-    ]
+def get_significance_analysis(
+    control_name,
+    driver,
+    connections=feature_connections,
+    alpha=0.05,
+    method="auto",
+    processes=1,
+):
+    # Significance of every feature of every disease against the control
+    # (see significance.test_against_control), one result per node type.
+    matrices = get_disease_feature_matrices(driver, connections)
+    results = {}
+    for _, node_type in connections:
+        result = test_against_control(
+            matrices[node_type], control_name, method=method, processes=processes
+        )
+        utils.log_section(f"Significant {node_type} features (q < {alpha})")
+        for disease_name, count in zip(result.diseases, count_significant(result, alpha)):
+            log_to_file(f"{disease_name}: {count}\n", key=disease_name, value=int(count))
+        results[node_type] = result
+    return results
+
+
+def get_permutation_analysis(
+    control_name,
+    cohort_index,
+    connections=feature_connections,
+    alpha=0.05,
+    permutations=1000,
+    processes=1,
+    seed=0,
+):
+    # Label permutation p-values of every feature of every disease against
+    # the control (see permutation.permutation_test), one result per node type.
+    results = {}
+    for relationship_type, node_type in connections:
+        result = permutation_test(
+            cohort_index,
+            relationship_type,
+            node_type,
+            control_name=control_name,
+            permutations=permutations,
+            seed=seed,
+            processes=processes,
+        )
+        utils.log_section(f"Permutation {node_type} features (p < {alpha}, {permutations} permutations)")
+        for disease_name, p_values in zip(result.diseases, result.p_values):
+            count = int((p_values < alpha).sum())
+            log_to_file(f"{disease_name}: {count}\n", key=disease_name, value=count)
+        results[node_type] = result
+    return results
+
+
+_worker_control = {}
+
+
+def _init_comparison_worker(control_common_groups, control_occurences, log_options):
+    # runs once per worker process, so the control groups are pickled once
+    # per worker instead of once per disease. Workers are spawned, so the
+    # log settings of the parent are passed along.
+    utils.configure_log(**log_options)
+    set_batch_mode(True)
+    _worker_control["common_groups"] = control_common_groups
+    _worker_control["occurences"] = control_occurences
+
+
+def _compare_in_worker(disease_name, disease_common_groups, disease_occurences):
+    return compare_control_disease_common_groups(
+        disease_name,
+        disease_common_groups,
+        _worker_control["common_groups"],
+        _worker_control["occurences"],
+        disease_occurences,
+    )
+
+
+def print_progress(done, total, disease_name, elapsed, error=None):
+    status = f"failed: {error}" if error else "done"
+    print(f"[{done}/{total}] {disease_name} {status} ({elapsed:.1f}s)")
+
+
+def get_all_control_disease_comparisons_concurrently(
+    control_name,
+    driver,
+    occurrences=5,
+    max_in_flight=4,
+    processes=None,
+    progress=print_progress,
+    feature_writer=None,
+    cohort_index=None,
+):
+    # Extraction runs in a thread pool with at most max_in_flight queries
+    # at a time (the driver must be thread safe, e.g. SessionManager with
+    # pool_size >= max_in_flight); comparison and plotting of the extracted
+    # diseases run in a process pool at the same time. With a cohort_index
+    # (cohort_index.CohortIndex) extraction is an in-process lookup.
+    connections = feature_connections
+
+    control_occurences = get_number_of_occurences(control_name, driver, cohort_index)
+    control_common_groups = get_common_groups(
+        connections, control_name, driver, cohort_index=cohort_index
+    )
+
+    diseases = run_query(
+        driver, "diseases_with_max_occurrences", {"occurrences": occurrences}
+    )
+    diseases = [disease for disease in diseases if disease["name"] != control_name]
+    total = len(diseases)
+    results = {}
+    start = time.perf_counter()
+    log_options = {
+        name: getattr(utils.log_sink, name)
+        for name in ("path", "json_path", "flush_every", "echo", "human_readable", "structured")
+    }
+    # Workers start while extraction threads may hold the profiler, log or
+    # QueryCache locks; a forked worker would inherit them held.
+    with ThreadPoolExecutor(max_workers=max_in_flight) as extraction_pool, ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_comparison_worker,
+        initargs=(control_common_groups, control_occurences, log_options),
+    ) as comparison_pool:
+        extractions = {
+            extraction_pool.submit(
+                get_common_groups,
+                connections,
+                disease["name"],
+                driver,
+                feature_writer,
+                cohort_index,
+            ): disease
+            for disease in diseases
+        }
+        comparisons = {}
+        pending = set(extractions)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in extractions:
+                    disease = extractions.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        results[disease["name"]] = None
+                        elapsed = time.perf_counter() - start
+                        progress(len(results), total, disease["name"], elapsed, error)
+                        continue
+                    comparison = comparison_pool.submit(
+                        _compare_in_worker,
+                        disease["name"],
+                        future.result(),
+                        disease["count"],
+                    )
+                    comparisons[comparison] = disease["name"]
+                    pending.add(comparison)
+                else:
+                    disease_name = comparisons.pop(future)
+                    error = future.exception()
+                    results[disease_name] = None if error else future.result()
+                    elapsed = time.perf_counter() - start
+                    progress(len(results), total, disease_name, elapsed, error)
+    return results
+
+
+@profiled
+def get_common_groups(connections, disease_name, driver, feature_writer=None, cohort_index=None):
+    if cohort_index is not None:
+        disease_count = cohort_index.get_disease_count(disease_name)
+    else:
+        disease_count = graph_structure.get_disease_counts(driver, name=disease_name)[
+            disease_name
+        ]
     results = []
     for connection in connections:
         node_type = connection[1]
@@ -224,6 +450,8 @@ def get_common_groups(connections, disease_name, driver):
             driver,
             node_type,
             relationship_type,
+            feature_writer=feature_writer,
+            cohort_index=cohort_index,
         )
         results.append(
             {
@@ -235,15 +463,21 @@ def get_common_groups(connections, disease_name, driver):
 
 
 def get_disease_analysis():
-    driver = GraphDatabase.driver(
-        utils.NEO4J_URL, auth=(utils.NEO4J_LOGIN, utils.NEO4J_PASSWORD)
-    )
+    start_profiling()
+    session_manager = SessionManager(pool_size=8)
+    driver = QueryCache(session_manager)
     clear_log_file()
     log_to_file("Disease analysis\n")
     # control_name = "esophagitis"
     control_name = "control"
-    get_all_control_disease_comparisons(control_name, driver, occurrences=100)
-    get_all_control_disease_comparisons(control_name, driver, occurrences=5)
+    get_all_control_disease_comparisons_concurrently(control_name, driver, occurrences=100)
+    get_all_control_disease_comparisons_concurrently(control_name, driver, occurrences=5)
+    print(f"Total query time: {session_manager.total_time():.2f}s, cache hits: {driver.hits}")
+    driver.close()
+    profiler = stop_profiling()
+    profiler.report()
+    profiler.to_json("./profile_disease_analysis.json")
+    profiler.to_csv("./profile_disease_analysis")
 
 
 
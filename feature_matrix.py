@@ -0,0 +1,96 @@
+from collections import namedtuple
+import numpy as np
+from scipy import sparse
+from utils import feature_connections
+from queries import run_query, stream_query
+
+
+# counts[i, j] is the number of samples of diseases[i] connected to
+# features[j], totals[i] the number of distinct connected nodes (like
+# get_total_association_count_for_disease) and disease_counts[i] the
+# number of samples with the disease.
+FeatureMatrix = namedtuple(
+    "FeatureMatrix", ["diseases", "features", "counts", "totals", "disease_counts"]
+)
+
+
+def get_all_disease_counts(driver, diseases=None):
+    result = run_query(driver, "all_disease_counts", {"diseases": diseases})
+    return {row["name"]: row["disease_count"] for row in result}
+
+
+def get_feature_occurrences(driver, connections=feature_connections, diseases=None):
+    # One pass over disease -> sample -> feature for every connection at once,
+    # one row per (disease, relationship, node).
+    parameters = {
+        "connections": [list(connection) for connection in connections],
+        "diseases": diseases,
+    }
+    return stream_query(
+        driver,
+        "feature_occurrences",
+        parameters,
+        rels="|".join(sorted({relationship for relationship, _ in connections})),
+    )
+
+
+def get_disease_feature_matrices(driver, connections=feature_connections, diseases=None):
+    disease_counts = get_all_disease_counts(driver, diseases)
+    disease_names = list(disease_counts.keys())
+    disease_index = {name: i for i, name in enumerate(disease_names)}
+    node_types = {relationship: node_type for relationship, node_type in connections}
+
+    features = {node_type: {} for node_type in node_types.values()}
+    # nodes sharing a name share a column and, like the dict from
+    # get_type_occurrence_for_disease, the last of their counts is kept
+    values = {node_type: {} for node_type in node_types.values()}
+    totals = {
+        node_type: np.zeros(len(disease_names), dtype=np.int64)
+        for node_type in node_types.values()
+    }
+
+    for row in get_feature_occurrences(driver, connections, diseases):
+        node_type = node_types[row["relationship"]]
+        i = disease_index.get(row["disease"])
+        if i is None:
+            continue
+        totals[node_type][i] += 1
+        if row["node_name"] is None:
+            continue
+        feature_index = features[node_type]
+        j = feature_index.setdefault(row["node_name"], len(feature_index))
+        values[node_type][i, j] = row["samples_with_node"]
+
+    counts_array = np.array(
+        [disease_counts[name] for name in disease_names], dtype=np.int64
+    )
+    matrices = {}
+    for node_type in node_types.values():
+        cells = np.array(list(values[node_type].keys()), dtype=np.int64).reshape(-1, 2)
+        counts = sparse.coo_matrix(
+            (list(values[node_type].values()), (cells[:, 0], cells[:, 1])),
+            shape=(len(disease_names), len(features[node_type])),
+            dtype=np.int64,
+        ).tocsr()
+        matrices[node_type] = FeatureMatrix(
+            diseases=disease_names,
+            features=list(features[node_type].keys()),
+            counts=counts,
+            totals=totals[node_type],
+            disease_counts=counts_array,
+        )
+    return matrices
+
+
+def get_common_group(matrix, disease_name):
+    i = matrix.diseases.index(disease_name)
+    row = matrix.counts.getrow(i)
+    return {matrix.features[j]: int(count) for j, count in zip(row.indices, row.data)}
+
+
+def get_common_groups_from_matrices(matrices, disease_name, connections=feature_connections):
+    # Same shape as disease_analysis.get_common_groups
+    return [
+        {node_type: get_common_group(matrices[node_type], disease_name)}
+        for _, node_type in connections
+    ]
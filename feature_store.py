@@ -0,0 +1,217 @@
+import os
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+FEATURE_STORE = "./patient_features_store"
+ROW_GROUP_SIZE = 65536
+
+FEATURES_SCHEMA = pa.schema(
+    [
+        ("disease", pa.string()),
+        ("relationship", pa.string()),
+        ("node_type", pa.string()),
+        ("node", pa.string()),
+        ("occurrences", pa.int64()),
+    ]
+)
+GENERAL_SCHEMA = pa.schema(
+    [
+        ("disease", pa.string()),
+        ("relationship", pa.string()),
+        ("node_type", pa.string()),
+        ("total_associations", pa.int64()),
+        ("total_samples", pa.int64()),
+    ]
+)
+
+
+def get_keys(table):
+    # "<disease>\x00<relationship>" per row, the unit a rerun replaces
+    return pc.binary_join_element_wise(
+        table.column("disease"), table.column("relationship"), "\x00"
+    )
+
+
+def read_table(file_name, schema, expression=None):
+    if not os.path.exists(file_name):
+        return schema.empty_table()
+    dataset = ds.dataset(file_name, format="parquet", schema=schema)
+    return dataset.to_table(filter=expression)
+
+
+class FeatureWriter:
+    # Columnar replacement for utils.save_feature_analysis_to_file. The store
+    # is two Parquet files, <path>/features.parquet and <path>/general.parquet,
+    # sorted by disease and relationship so that a filter on disease only
+    # reads the row groups whose statistics cover it. general keeps one row
+    # per (disease, relationship, node type). Rows are buffered until flush
+    # or close, which merge them into the store: like the per-disease files,
+    # a (disease, relationship) written again replaces its earlier rows, both
+    # within a writer (last write wins) and across runs.
+    def __init__(self, path=FEATURE_STORE, batch_size=500000, row_group_size=ROW_GROUP_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.row_group_size = row_group_size
+        self._features = {name: [] for name in FEATURES_SCHEMA.names}
+        self._general = {name: [] for name in GENERAL_SCHEMA.names}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # buffered rows, batch_size at a time, as (features, general) tables,
+        # and the chunk that last wrote each (disease, relationship)
+        self._chunks = []
+        self._latest = {}
+
+    def add(
+        self,
+        disease_name,
+        common_group,
+        total_association,
+        disease_count,
+        node_type,
+        relationship_type,
+    ):
+        with self._lock:
+            key = f"{disease_name}\x00{relationship_type}"
+            if self._latest.get(key) == len(self._chunks):
+                self._convert()
+            self._latest[key] = len(self._chunks)
+            count = len(common_group)
+            self._features["disease"] += [disease_name] * count
+            self._features["relationship"] += [relationship_type] * count
+            self._features["node_type"] += [node_type] * count
+            self._features["node"] += list(common_group.keys())
+            self._features["occurrences"] += list(common_group.values())
+            self._general["disease"].append(disease_name)
+            self._general["relationship"].append(relationship_type)
+            self._general["node_type"].append(node_type)
+            self._general["total_associations"].append(total_association)
+            self._general["total_samples"].append(disease_count)
+            if len(self._features["node"]) >= self.batch_size:
+                self._convert()
+
+    def write_tables(self, features_table, general_table):
+        with self._lock:
+            self._convert()
+            for key in get_keys(general_table).to_pylist():
+                self._latest[key] = len(self._chunks)
+            self._chunks.append((features_table, general_table))
+
+    def _convert(self):
+        if not self._general["disease"]:
+            return
+        self._chunks.append(
+            (
+                pa.table(self._features, schema=FEATURES_SCHEMA),
+                pa.table(self._general, schema=GENERAL_SCHEMA),
+            )
+        )
+        self._features = {name: [] for name in FEATURES_SCHEMA.names}
+        self._general = {name: [] for name in GENERAL_SCHEMA.names}
+
+    def _flush(self):
+        self._convert()
+        if not self._chunks:
+            return
+        replaced = pa.array(list(self._latest.keys()), type=pa.string())
+        for index, (table_name, schema, sort_keys) in enumerate(
+            (
+                ("features", FEATURES_SCHEMA, ["disease", "relationship", "node"]),
+                ("general", GENERAL_SCHEMA, ["disease", "relationship", "node_type"]),
+            )
+        ):
+            file_name = f"{self.path}/{table_name}.parquet"
+            existing = read_table(file_name, schema)
+            tables = [existing.filter(pc.invert(pc.is_in(get_keys(existing), replaced)))]
+            for chunk_index, chunk in enumerate(self._chunks):
+                table = chunk[index]
+                latest = pa.array(
+                    [key for key, i in self._latest.items() if i == chunk_index], type=pa.string()
+                )
+                tables.append(table.filter(pc.is_in(get_keys(table), latest)))
+            table = pa.concat_tables(tables).sort_by([(key, "ascending") for key in sort_keys])
+            pq.write_table(table, f"{file_name}.tmp", row_group_size=self.row_group_size)
+            os.replace(f"{file_name}.tmp", file_name)
+        self._chunks = []
+        self._latest = {}
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_feature_matrices(matrices, connections, path=FEATURE_STORE):
+    # Bulk export of feature_matrix.get_disease_feature_matrices output into
+    # the store (replacing the rows of its diseases), without going
+    # through per-disease dicts.
+    writer = FeatureWriter(path)
+    features = []
+    general = []
+    for relationship_type, node_type in connections:
+        matrix = matrices[node_type]
+        counts = matrix.counts.tocsr()
+        diseases = np.asarray(matrix.diseases, dtype=object)
+        feature_names = np.asarray(matrix.features, dtype=object)
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        features.append(
+            pa.table(
+                {
+                    "disease": diseases[rows],
+                    "relationship": np.full(len(rows), relationship_type, dtype=object),
+                    "node_type": np.full(len(rows), node_type, dtype=object),
+                    "node": feature_names[counts.indices],
+                    "occurrences": counts.data.astype(np.int64),
+                },
+                schema=FEATURES_SCHEMA,
+            )
+        )
+        general.append(
+            pa.table(
+                {
+                    "disease": diseases,
+                    "relationship": np.full(len(diseases), relationship_type, dtype=object),
+                    "node_type": np.full(len(diseases), node_type, dtype=object),
+                    "total_associations": np.asarray(matrix.totals, dtype=np.int64),
+                    "total_samples": np.asarray(matrix.disease_counts, dtype=np.int64),
+                },
+                schema=GENERAL_SCHEMA,
+            )
+        )
+    writer.write_tables(pa.concat_tables(features), pa.concat_tables(general))
+    writer.close()
+
+
+def get_filter(diseases=None, node_type=None):
+    expression = None
+    if diseases is not None:
+        expression = ds.field("disease").isin(list(diseases))
+    if node_type is not None:
+        node_type_expression = ds.field("node_type") == node_type
+        expression = node_type_expression if expression is None else expression & node_type_expression
+    return expression
+
+
+def load_feature_table(path=FEATURE_STORE, diseases=None, node_type=None):
+    return read_table(f"{path}/features.parquet", FEATURES_SCHEMA, get_filter(diseases, node_type))
+
+
+def load_general_table(path=FEATURE_STORE, diseases=None, node_type=None):
+    return read_table(f"{path}/general.parquet", GENERAL_SCHEMA, get_filter(diseases, node_type))
+
+
+def load_common_group(disease_name, node_type, path=FEATURE_STORE):
+    table = load_feature_table(path, [disease_name], node_type)
+    return dict(zip(table.column("node").to_pylist(), table.column("occurrences").to_pylist()))
@@ -0,0 +1,363 @@
+import json
+import os
+import numpy as np
+from scipy import sparse
+from session_manager import SessionManager
+from utils import stream_column_batches
+from queries import get_query
+
+
+SNAPSHOT_FOLDER = "./graph_snapshot"
+SAMPLE_LABEL = "Biological_sample"
+SNAPSHOT_CONNECTIONS = [
+    ("HAS_DISEASE", "Disease"),
+    ("HAS_PHENOTYPE", "Phenotype"),
+    ("HAS_PROTEIN", "Protein"),
+    ("HAS_DAMAGE", "Gene"),
+    ("BELONGS_TO_SUBJECT", "Subject"),
+]
+
+
+def export_nodes(driver, label, path, fetch_size):
+    ids = []
+    names = []
+    for batch in stream_column_batches(
+        driver, get_query("snapshot_nodes", label=label), fetch_size=fetch_size
+    ):
+        ids.append(batch["id"].astype(np.int64))
+        names += batch["name"].tolist()
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    return save_nodes(path, label, ids, names)
+
+
+def save_nodes(path, label, ids, names):
+    # nodes are stored sorted by internal id; their position is their index
+    order = np.argsort(ids)
+    np.save(f"{path}/{label}_ids.npy", ids[order])
+    with open(f"{path}/{label}_names.json", "w") as f:
+        json.dump([names[i] for i in order], f)
+    return ids[order]
+
+
+def export_edges(driver, rel, label, sample_ids, node_ids, path, fetch_size):
+    # CSR adjacency sample -> node, both as indices into the sorted id arrays.
+    # Parallel edges are kept, the Cypher queries count distinct relationships.
+    samples = []
+    nodes = []
+    query = get_query("snapshot_edges", rel=rel, label=label)
+    for batch in stream_column_batches(driver, query, fetch_size=fetch_size):
+        samples.append(np.searchsorted(sample_ids, batch["sample"].astype(np.int64)))
+        nodes.append(np.searchsorted(node_ids, batch["node"].astype(np.int64)))
+    samples = np.concatenate(samples) if samples else np.zeros(0, dtype=np.int64)
+    nodes = np.concatenate(nodes) if nodes else np.zeros(0, dtype=np.int64)
+    save_edges(path, rel, samples, nodes, len(sample_ids))
+
+
+def save_edges(path, rel, samples, nodes, sample_count):
+    order = np.argsort(samples, kind="stable")
+    indptr = np.zeros(sample_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(samples, minlength=sample_count), out=indptr[1:])
+    np.save(f"{path}/{rel}_indptr.npy", indptr)
+    np.save(f"{path}/{rel}_indices.npy", nodes[order].astype(np.int32))
+
+
+def save_meta(path, connections):
+    with open(f"{path}/meta.json", "w") as f:
+        json.dump({"connections": connections}, f)
+
+
+def export_snapshot(driver, path=SNAPSHOT_FOLDER, connections=SNAPSHOT_CONNECTIONS, fetch_size=10000):
+    os.makedirs(path, exist_ok=True)
+    sample_ids = export_nodes(driver, SAMPLE_LABEL, path, fetch_size)
+    for rel, label in connections:
+        node_ids = export_nodes(driver, label, path, fetch_size)
+        export_edges(driver, rel, label, sample_ids, node_ids, path, fetch_size)
+        print(f"Exported {rel} -> {label}")
+    save_meta(path, connections)
+
+
+class GraphSnapshot:
+    # Database-free backend for the analysis functions: answers the
+    # queries.QUERIES entries they use from the memory-mapped CSR arrays
+    # written by export_snapshot. Pass it wherever a driver is expected.
+    # Queries it does not answer, and labels, relationships or filters that
+    # are not in the snapshot, raise ValueError.
+    def __init__(self, path=SNAPSHOT_FOLDER, mmap_mode="r"):
+        with open(f"{path}/meta.json", "r") as f:
+            self.connections = [tuple(c) for c in json.load(f)["connections"]]
+        self.labels = {rel: label for rel, label in self.connections}
+        self.names = {}
+        self.name_index = {}
+        for label in [SAMPLE_LABEL] + list(self.labels.values()):
+            with open(f"{path}/{label}_names.json", "r") as f:
+                self.names[label] = json.load(f)
+        self.sample_count = len(self.names[SAMPLE_LABEL])
+        self.indptr = {}
+        self.indices = {}
+        for rel, _ in self.connections:
+            self.indptr[rel] = np.load(f"{path}/{rel}_indptr.npy", mmap_mode=mmap_mode)
+            self.indices[rel] = np.load(f"{path}/{rel}_indices.npy", mmap_mode=mmap_mode)
+        self._edge_samples = {}
+        self._matrices = {}
+
+    def run(self, query, parameters=None):
+        raise ValueError(
+            "GraphSnapshot only answers queries.QUERIES entries through run_query / stream_query, "
+            f"supported: {', '.join(self.get_supported_queries())}"
+        )
+
+    def close(self):
+        pass
+
+    # -- array helpers
+
+    def get_node_indices(self, label, name):
+        if label not in self.name_index:
+            index = {}
+            for i, node_name in enumerate(self.names[label]):
+                index.setdefault(node_name, []).append(i)
+            self.name_index[label] = index
+        return np.asarray(self.name_index[label].get(name, []), dtype=np.int64)
+
+    def get_edge_samples(self, rel):
+        # sample index of every edge, aligned with indices[rel]
+        if rel not in self._edge_samples:
+            degrees = np.diff(self.indptr[rel])
+            self._edge_samples[rel] = np.repeat(np.arange(self.sample_count), degrees)
+        return self._edge_samples[rel]
+
+    def get_matrix(self, rel):
+        # samples x nodes, entries are the number of parallel edges
+        if rel not in self._matrices:
+            label = self.labels[rel]
+            indices = self.indices[rel]
+            self._matrices[rel] = sparse.csr_matrix(
+                (np.ones(len(indices), dtype=np.int64), indices, self.indptr[rel]),
+                shape=(self.sample_count, len(self.names[label])),
+            )
+        return self._matrices[rel]
+
+    def get_cohort(self, disease_name):
+        # unique sample indices with a HAS_DISEASE edge to a disease of that name
+        diseases = self.get_node_indices("Disease", disease_name)
+        mask = np.isin(self.indices["HAS_DISEASE"], diseases)
+        return np.unique(self.get_edge_samples("HAS_DISEASE")[mask])
+
+    def get_disease_edge_counts(self):
+        # count(r) of HAS_DISEASE per disease node
+        return np.bincount(self.indices["HAS_DISEASE"], minlength=len(self.names["Disease"]))
+
+    def get_disease_counts_by_name(self):
+        # nameless diseases are skipped, as d.name <> 'control' drops them
+        counts = {}
+        for name, count in zip(self.names["Disease"], self.get_disease_edge_counts()):
+            if name is None:
+                continue
+            counts[name] = counts.get(name, 0) + int(count)
+        return counts
+
+    def get_cohort_occurrences(self, cohort, rel):
+        # count(DISTINCT r) per node over the samples of the cohort
+        return np.asarray(self.get_matrix(rel)[cohort].sum(axis=0)).ravel()
+
+    # -- catalog queries
+
+    @classmethod
+    def get_supported_queries(cls):
+        return sorted(name[len("query_") :] for name in dir(cls) if name.startswith("query_"))
+
+    def run_catalog(self, name, parameters, template_args):
+        handler = getattr(self, f"query_{name}", None)
+        if handler is None:
+            raise ValueError(
+                f"Query {name} is not supported by GraphSnapshot, "
+                f"supported: {', '.join(self.get_supported_queries())}"
+            )
+        return handler(parameters, **template_args)
+
+    def check_relationship(self, relationship_type, node_type):
+        if self.labels.get(relationship_type) != node_type:
+            raise ValueError(f"{relationship_type} -> {node_type} is not in the snapshot")
+
+    def query_disease_counts(self, parameters, limit=""):
+        counts = [
+            {"name": name, "disease_count": count}
+            for name, count in self.get_disease_counts_by_name().items()
+            if count >= parameters["min_occurrence"] and name != "control"
+        ]
+        counts.sort(key=lambda row: row["disease_count"], reverse=True)
+        if limit:
+            counts = counts[: parameters["top_k"]]
+        return counts
+
+    def query_disease_count_by_name(self, parameters):
+        diseases = self.get_node_indices("Disease", parameters["name"])
+        if len(diseases) == 0:
+            return []
+        count = int(self.get_disease_edge_counts()[diseases].sum())
+        if count < parameters["min_occurrence"]:
+            return []
+        return [{"name": parameters["name"], "disease_count": count}]
+
+    def query_all_disease_counts(self, parameters):
+        diseases = parameters.get("diseases")
+        counts = [
+            {"name": name, "disease_count": count}
+            for name, count in self.get_disease_counts_by_name().items()
+            if count > 0 and (diseases is None or name in diseases)
+        ]
+        counts.sort(key=lambda row: row["disease_count"], reverse=True)
+        return counts
+
+    def query_number_of_occurrences(self, parameters):
+        diseases = self.get_node_indices("Disease", parameters["name"])
+        return [{"count": int(np.isin(self.indices["HAS_DISEASE"], diseases).sum())}]
+
+    def query_diseases_with_max_occurrences(self, parameters):
+        counts = self.get_disease_edge_counts()
+        rows = [
+            {"name": self.names["Disease"][i], "count": int(counts[i])}
+            for i in np.nonzero((counts > 0) & (counts <= parameters["occurrences"]))[0]
+        ]
+        rows.sort(key=lambda row: row["count"], reverse=True)
+        return rows
+
+    def query_total_association_count_for_disease(self, parameters, node_type, relationship_type):
+        self.check_relationship(relationship_type, node_type)
+        cohort = self.get_cohort(parameters["name"])
+        occurrences = self.get_cohort_occurrences(cohort, relationship_type)
+        total = int(np.count_nonzero(occurrences))
+        if total == 0:
+            return []
+        return [{"Disease": parameters["name"], "total_associations": total}]
+
+    def query_type_occurrence_for_disease(self, parameters, node_type, relationship_type):
+        self.check_relationship(relationship_type, node_type)
+        cohort = self.get_cohort(parameters["name"])
+        occurrences = self.get_cohort_occurrences(cohort, relationship_type)
+        names = self.names[node_type]
+        return [
+            {"node_name": names[j], "samples_with_node": int(occurrences[j])}
+            for j in np.nonzero(occurrences)[0]
+        ]
+
+    def query_feature_occurrences(self, parameters, rels):
+        # disease-name x sample incidence times sample x node counts
+        disease_names = sorted(set(self.names["Disease"]) - {None})
+        if parameters.get("diseases") is not None:
+            disease_names = [name for name in disease_names if name in parameters["diseases"]]
+        name_index = {name: i for i, name in enumerate(disease_names)}
+        edge_diseases = np.array(
+            [name_index.get(self.names["Disease"][i], -1) for i in range(len(self.names["Disease"]))],
+            dtype=np.int64,
+        )[self.indices["HAS_DISEASE"]]
+        keep = edge_diseases >= 0
+        cohorts = sparse.csr_matrix(
+            (
+                np.ones(int(keep.sum()), dtype=np.int64),
+                (edge_diseases[keep], self.get_edge_samples("HAS_DISEASE")[keep]),
+            ),
+            shape=(len(disease_names), self.sample_count),
+        )
+        cohorts.data[:] = 1
+        rows = []
+        for relationship_type, node_type in parameters["connections"]:
+            if relationship_type not in rels.split("|"):
+                continue
+            self.check_relationship(relationship_type, node_type)
+            occurrences = (cohorts @ self.get_matrix(relationship_type)).tocoo()
+            names = self.names[node_type]
+            for i, j, count in zip(occurrences.row, occurrences.col, occurrences.data):
+                rows.append(
+                    {
+                        "disease": disease_names[i],
+                        "relationship": relationship_type,
+                        "node_name": names[j],
+                        "samples_with_node": int(count),
+                    }
+                )
+        return rows
+
+    def get_samples_with_disease(self, exclude_control):
+        control = self.get_node_indices("Disease", "control")
+        is_control = np.isin(self.indices["HAS_DISEASE"], control)
+        mask = ~is_control if exclude_control else is_control
+        return np.unique(self.get_edge_samples("HAS_DISEASE")[mask])
+
+    def query_sick_people(self, parameters):
+        return [{"sick_people": len(self.get_samples_with_disease(exclude_control=True))}]
+
+    def query_healthy_people(self, parameters):
+        return [{"healthy_people": len(self.get_samples_with_disease(exclude_control=False))}]
+
+    def query_undiagnosed_people(self, parameters):
+        return [{"undiagnosed": int((np.diff(self.indptr["HAS_DISEASE"]) == 0).sum())}]
+
+    def query_node_count(self, parameters, label, wcc_query=""):
+        if wcc_query or label not in self.names:
+            raise ValueError(f"Node count of {label} is not supported by GraphSnapshot")
+        return [{"count": len(self.names[label])}]
+
+    def get_degree_stats(self, start, rel, end):
+        if start != SAMPLE_LABEL:
+            raise ValueError(f"{start} is not in the snapshot")
+        self.check_relationship(rel, end)
+        degrees = np.diff(self.indptr[rel])
+        stats = {
+            "min": int(degrees.min()) if len(degrees) else None,
+            "max": int(degrees.max()) if len(degrees) else None,
+            "avg": float(degrees.mean()) if len(degrees) else None,
+            # stDev in Cypher is the sample standard deviation
+            "stDev": float(degrees.std(ddof=1)) if len(degrees) > 1 else 0.0,
+            "count": int(degrees.sum()),
+        }
+        return stats
+
+    def query_rel_degree_stats(self, parameters, start, rel, end, wcc_query=""):
+        if wcc_query:
+            raise ValueError("wccComponentId is not in the snapshot")
+        stats = self.get_degree_stats(start, rel, end)
+        del stats["count"]
+        return [stats]
+
+    def query_rel_total_count(self, parameters, start, rel, end):
+        return [{"count": self.get_degree_stats(start, rel, end)["count"]}]
+
+    def query_rel_degree_stats_for_start(self, parameters, start, rels, wcc_query="true"):
+        if wcc_query != "true":
+            raise ValueError("wccComponentId is not in the snapshot")
+        rows = []
+        for triple in parameters["triples"]:
+            stats = self.get_degree_stats(start, triple["rel"], triple["end"])
+            rows.append({"rel": triple["rel"], "end": triple["end"], **stats})
+        return rows
+
+
+    def get_degree_table(self, start, rel, end):
+        if start != SAMPLE_LABEL:
+            raise ValueError(f"{start} is not in the snapshot")
+        self.check_relationship(rel, end)
+        degrees, nodes = np.unique(np.diff(self.indptr[rel]), return_counts=True)
+        return degrees, nodes
+
+    def query_rel_degree_histogram(self, parameters, start, rel, end, wcc_query=""):
+        if wcc_query:
+            raise ValueError("wccComponentId is not in the snapshot")
+        degrees, nodes = self.get_degree_table(start, rel, end)
+        return [{"degree": int(d), "nodes": int(n)} for d, n in zip(degrees, nodes)]
+
+    def query_rel_degree_histogram_for_start(self, parameters, start, rels, wcc_query="true"):
+        if wcc_query != "true":
+            raise ValueError("wccComponentId is not in the snapshot")
+        rows = []
+        for triple in parameters["triples"]:
+            degrees, nodes = self.get_degree_table(start, triple["rel"], triple["end"])
+            for d, n in zip(degrees, nodes):
+                rows.append(
+                    {"rel": triple["rel"], "end": triple["end"], "degree": int(d), "nodes": int(n), "count": int(d * n)}
+                )
+        return rows
+
+if __name__ == "__main__":
+    with SessionManager() as session_manager:
+        export_snapshot(session_manager)
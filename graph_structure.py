@@ -1,48 +1,248 @@
 # %%
-from neo4j import GraphDatabase
+from session_manager import SessionManager
+from query_cache import QueryCache
+from stats_store import StatsStore
 import matplotlib.pyplot as plt
 import math
+import numpy as np
 from random import randrange
-from utils import request, log_to_file, clear_log_file
-import utils
+from utils import log_to_file, log_section, clear_log_file
+from profiler import profiled, start_profiling, stop_profiling
+from queries import run_query, stream_query, get_query
+from scipy.stats import norm
+from hyperloglog import HyperLogLog, get_server_hash_parameters
 
 
+@profiled
 def get_node_count(label, driver, use_wccComponent=False):
     wcc_query = "where n.wccComponentId = 0" if use_wccComponent else ""
-    query = f"MATCH (n:{label}) {wcc_query} RETURN count(n) as count"
-    result = request(driver, query)
-    log_to_file(f"{label}: {result[0]['count']} \n")
+    result = run_query(driver, "node_count", label=label, wcc_query=wcc_query)
+    log_to_file(f"{label}: {result[0]['count']} \n", key=label, value=result[0]["count"])
+    return result[0]["count"]
 
 
+DEGREE_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# stats of rel_degree_stats and rel_total_count without start nodes
+EMPTY_DEGREE_STATS = {"min": None, "max": None, "avg": None, "stDev": 0.0, "count": 0}
+
+
+@profiled
 def get_rel_min_max_avg(
     start,
     rel,
     end,
     driver,
     use_wccComponent=False,
+    histogram=False,
+):
+    # With histogram, the server returns the number of start nodes per degree
+    # instead of the aggregates, and the stats, quantiles and a log-binned
+    # histogram are computed from that table.
+    wcc_query = "where a.wccComponentId = 0 and b.wccComponentId =0" if use_wccComponent else ""
+    template_args = {"start": start, "rel": rel, "end": end}
+    query_name = "rel_degree_histogram" if histogram else "rel_degree_stats"
+    print(get_query(query_name, wcc_query=wcc_query, **template_args))
+
+    result = run_query(driver, query_name, wcc_query=wcc_query, **template_args)
+    if histogram:
+        stats = get_degree_stats_from_histogram(
+            [row["degree"] for row in result], [row["nodes"] for row in result]
+        )
+    else:
+        stats = dict(result[0])
+    if not histogram or use_wccComponent:
+        # without the wcc filter the degrees already sum up to the total
+        result = run_query(driver, "rel_total_count", **template_args)
+        stats["count"] = result[0]["count"]
+    log_rel_min_max_avg(start, rel, end, stats)
+    return stats
+
+
+def get_degree_stats_from_histogram(degrees, nodes, quantiles=DEGREE_QUANTILES):
+    # nodes[i] start nodes have degrees[i] relationships. Degrees are binned
+    # as 0, 1, 2-3, 4-7, ...; stDev is the sample standard deviation like in
+    # Cypher and quantiles are nearest rank.
+    degrees = np.asarray(degrees, dtype=np.int64)
+    nodes = np.asarray(nodes, dtype=np.int64)
+    order = np.argsort(degrees)
+    degrees = degrees[order]
+    nodes = nodes[order]
+    total = int(nodes.sum())
+    stats = {
+        "min": None,
+        "max": None,
+        "avg": None,
+        "stDev": None,
+        "count": int(np.dot(degrees, nodes)),
+        "quantiles": {},
+        "histogram": {"edges": [], "counts": []},
+        "degree_table": [[int(d), int(n)] for d, n in zip(degrees, nodes)],
+    }
+    if total == 0:
+        return stats
+    avg = float(np.dot(degrees, nodes)) / total
+    variance = float(np.dot(nodes, (degrees - avg) ** 2)) / (total - 1) if total > 1 else 0.0
+    stats["min"] = int(degrees[0])
+    stats["max"] = int(degrees[-1])
+    stats["avg"] = avg
+    stats["stDev"] = math.sqrt(variance)
+    cumulative = np.cumsum(nodes)
+    for quantile in quantiles:
+        rank = max(math.ceil(quantile * total), 1)
+        stats["quantiles"][str(quantile)] = int(degrees[np.searchsorted(cumulative, rank)])
+    bins = np.frexp(degrees.astype(np.float64))[1]
+    counts = np.bincount(bins, weights=nodes).astype(np.int64)
+    stats["histogram"] = {
+        "edges": [0] + [2**i for i in range(len(counts))],
+        "counts": counts.tolist(),
+    }
+    return stats
+
+
+@profiled
+def get_approximate_rel_min_max_avg(
+    start,
+    rel,
+    end,
+    driver,
+    use_wccComponent=False,
+    sample_size=10000,
+    confidence=0.95,
+    distinct_counts=False,
 ):
+    # Degree stats of a random sample of about sample_size start nodes. min
+    # and max are those of the sample; avg and the total count come with a
+    # normal confidence interval. The count follows the wcc filter. With
+    # distinct_counts, HyperLogLog counts of the distinct start and end nodes
+    # are added; each is a full scan of the relationships, so they are off by
+    # default.
     wcc_query = "where a.wccComponentId = 0 and b.wccComponentId =0" if use_wccComponent else ""
-    query = f"""
-    MATCH (a:{start})
-    Optional MATCH (a:{start})-[r:{rel}]->(b:{end}) 
-    {wcc_query}
-    With count(distinct r) as rel_count, a as a
-    RETURN min(rel_count) as min, max(rel_count) as max, avg(rel_count) as avg, stDev(rel_count) as stDev
-    """
-    print(query)
-
-    result = request(driver, query)
+    population = run_query(driver, "node_count", label=start, wcc_query="")[0]["count"]
+    probability = min(1.0, sample_size / population) if population else 1.0
+    result = run_query(
+        driver,
+        "rel_degree_sample_stats",
+        {"probability": probability},
+        start=start,
+        rel=rel,
+        end=end,
+        wcc_query=wcc_query,
+    )
+    row = result[0]
+    n = row["sample_size"]
+    stats = {
+        "min": row["min"],
+        "max": row["max"],
+        "avg": row["avg"],
+        "stDev": row["stDev"],
+        "count": None,
+        "approximate": True,
+        "sample_size": n,
+        "avg_ci": None,
+        "count_ci": None,
+        "distinct_start": None,
+        "distinct_end": None,
+    }
+    if distinct_counts:
+        stats["distinct_start"] = get_approximate_distinct_count(start, rel, end, driver, key="id(a)")
+        stats["distinct_end"] = get_approximate_distinct_count(start, rel, end, driver, key="id(b)")
+    if n > 0:
+        # finite population correction, the interval closes when every node is sampled
+        correction = math.sqrt(max(population - n, 0) / (population - 1)) if population > 1 else 0
+        margin = float(norm.ppf(0.5 + confidence / 2)) * (row["stDev"] or 0) / math.sqrt(n) * correction
+        stats["count"] = round(row["avg"] * population)
+        stats["avg_ci"] = [max(row["avg"] - margin, 0), row["avg"] + margin]
+        stats["count_ci"] = [ci * population for ci in stats["avg_ci"]]
+    log_rel_min_max_avg(start, rel, end, stats)
+    return stats
+
+
+@profiled
+def get_approximate_distinct_count(start, rel, end, driver, key="id(b)", precision=14):
+    # Distinct values of key (default: the end nodes) over the relationships
+    # of the triple, as a HyperLogLog sketch whose registers are aggregated
+    # on the server: one row per register instead of count(distinct) state.
+    # key must be an integer expression.
+    sketch = HyperLogLog(precision)
+    result = run_query(
+        driver,
+        "hll_registers",
+        get_server_hash_parameters(precision),
+        start=start,
+        rel=rel,
+        end=end,
+        key=key,
+    )
+    sketch.add_registers([row["register"] for row in result], [row["rank"] for row in result])
+    return sketch.count()
+
+
+def log_rel_min_max_avg(start, rel, end, stats):
     log_to_file(
-        f"{start} -> [{rel}] -> {end}, min: {result[0]['min']}, max: {result[0]['max']}, avg: {result[0]['avg']}, stDev: {result[0]['stDev']}, "
+        f"{start} -> [{rel}] -> {end}, min: {stats['min']}, max: {stats['max']}, avg: {stats['avg']}, stDev: {stats['stDev']}, "
     )
-    query = f"""
-    MATCH (a:{start})-[r:{rel}]->(b:{end})
-    RETURN count(distinct r) as count
-    """
-    result = request(driver, query)
-    log_to_file(f"total count: {result[0]['count']} \n")
+    if stats.get("quantiles"):
+        log_to_file(f"quantiles: {stats['quantiles']}, ")
+    if stats.get("approximate"):
+        log_to_file(
+            f"sample size: {stats['sample_size']}, avg CI: {stats['avg_ci']}, count CI: {stats['count_ci']}, "
+        )
+        if stats.get("distinct_start") is not None:
+            log_to_file(
+                f"distinct start: ~{stats['distinct_start']}, distinct end: ~{stats['distinct_end']}, "
+            )
+    log_to_file(
+        f"total count: {stats['count']} \n", key=f"{start} -> [{rel}] -> {end}", value=stats
+    )
+
+
+@profiled
+def get_rel_min_max_avg_for_start(start, triples, driver, use_wccComponent=False, histogram=False):
+    # One expansion of the start label computes the stats of every (rel, end)
+    # pair leaving it. The total count ignores the wcc filter, like the
+    # separate count query in get_rel_min_max_avg.
+    wcc_query = "a.wccComponentId = 0 and b.wccComponentId = 0" if use_wccComponent else "true"
+    parameters = {"triples": [{"rel": rel, "end": end} for rel, end in triples]}
+    result = run_query(
+        driver,
+        "rel_degree_histogram_for_start" if histogram else "rel_degree_stats_for_start",
+        parameters,
+        start=start,
+        rels="|".join(sorted({rel for rel, _ in triples})),
+        wcc_query=wcc_query,
+    )
+    stats = {}
+    if histogram:
+        tables = {}
+        for row in result:
+            table = tables.setdefault((start, row["rel"], row["end"]), ([], [], []))
+            table[0].append(row["degree"])
+            table[1].append(row["nodes"])
+            table[2].append(row["count"])
+        for triple, (degrees, nodes, counts) in tables.items():
+            stats[triple] = get_degree_stats_from_histogram(degrees, nodes)
+            stats[triple]["count"] = sum(counts)
+    else:
+        for row in result:
+            stats[(start, row["rel"], row["end"])] = {
+                "min": row["min"],
+                "max": row["max"],
+                "avg": row["avg"],
+                "stDev": row["stDev"],
+                "count": row["count"],
+            }
+    # without start nodes the grouped query returns no rows, the per-triple
+    # queries return nulls and a count of 0
+    for rel, end in triples:
+        if (start, rel, end) not in stats:
+            if histogram:
+                stats[(start, rel, end)] = get_degree_stats_from_histogram([], [])
+            else:
+                stats[(start, rel, end)] = dict(EMPTY_DEGREE_STATS)
+    return stats
 
 
+@profiled
 def attribute_min_max_avg(
     start,
     rel,
@@ -50,35 +250,252 @@ def attribute_min_max_avg(
     attribute,
     driver,
 ):
-    query = f"""
-    MATCH (a:{start})-[r:{rel}]->(b:{end}) 
-    With collect(r.{attribute}) as values
-    UNWIND values as value
-    RETURN min(value) as min, max(value) as max, avg(value) as avg
-    """
-    result = request(driver, query)
+    result = run_query(
+        driver,
+        "attribute_min_max_avg",
+        start=start,
+        rel=rel,
+        end=end,
+        attribute=attribute,
+    )
     log_to_file(f"{start} -> [{rel}] -> {end}  | Attribute: {attribute}\n")
     log_to_file(
-        f"Min: {result[0]['min']}, Max: {result[0]['max']}, Avg: {result[0]['avg']}\n"
+        f"Min: {result[0]['min']}, Max: {result[0]['max']}, Avg: {result[0]['avg']}\n",
+        key=f"{start} -> [{rel}] -> {end} | {attribute}",
+        value=result[0],
     )
 
 
-def get_all_node_counts(labels, driver, use_wccComponent=False):
-    log_to_file("\n")
-    log_to_file("------------------------- Node counts ------------------------- \n")
-    for label in labels:
-        get_node_count(label, driver, use_wccComponent)
-
-
-def get_all_rel_min_max_avg(relationships, driver, use_wccComponent=False):
-    log_to_file("\n")
-    log_to_file(
-        "------------------------- Number of Relationships-------------------------\n"
+# scale of float attribute values before hashing them for the distinct count
+DISTINCT_FLOAT_SCALE = 1000000
+
+
+def get_attribute_aggregates(attributes, percentiles, exact=False):
+    # RETURN items of the attribute_profile query, prefixed per attribute.
+    # min/max/avg/stDev/count are running aggregates; with exact, the
+    # distinct count and the percentiles keep every value they have seen on
+    # the server.
+    aggregates = []
+    for i, attribute in enumerate(attributes):
+        value = f"r.`{attribute}`"
+        aggregates += [
+            f"count({value}) as a{i}_count",
+            f"min({value}) as a{i}_min",
+            f"max({value}) as a{i}_max",
+            f"avg({value}) as a{i}_avg",
+            f"stDev({value}) as a{i}_stDev",
+        ]
+        if exact:
+            aggregates.append(f"count(distinct {value}) as a{i}_distinct")
+            for j, percentile in enumerate(percentiles):
+                aggregates.append(f"percentileCont({value}, {float(percentile)}) as a{i}_p{j}")
+    return ", ".join(aggregates)
+
+
+def get_histogram_percentiles(edges, histogram, percentiles, minimum, maximum):
+    # linear interpolation inside the bin holding the rank, like percentileCont
+    # would give for values spread evenly over the bin
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+    result = {}
+    for percentile in percentiles:
+        rank = percentile * total
+        i = min(int(np.searchsorted(cumulative, rank)), len(histogram) - 1)
+        before = cumulative[i] - histogram[i]
+        fraction = (rank - before) / histogram[i] if histogram[i] else 0
+        value = edges[i] + fraction * (edges[i + 1] - edges[i])
+        result[percentile] = float(min(max(value, minimum), maximum))
+    return result
+
+
+def get_attribute_histogram(start, rel, end, attribute, minimum, maximum, driver, bins=10):
+    width = (maximum - minimum) / bins if maximum > minimum else 1
+    histogram = [0] * bins
+    result = run_query(
+        driver,
+        "attribute_histogram",
+        {"min": minimum, "width": width},
+        start=start,
+        rel=rel,
+        end=end,
+        attribute=f"`{attribute}`",
     )
-    for rel in relationships:
-        get_rel_min_max_avg(rel[0], rel[1], rel[2], driver,use_wccComponent)
+    for row in result:
+        # the maximum lands on the upper edge of the last bin
+        histogram[min(max(row["bin"], 0), bins - 1)] += row["count"]
+    edges = [minimum + i * width for i in range(bins + 1)]
+    return edges, histogram
 
 
+@profiled
+def profile_attributes(
+    specs,
+    driver,
+    percentiles=(0.25, 0.5, 0.75),
+    bins=10,
+    exact=False,
+    precision=14,
+):
+    # specs: list of (start, rel, end, [attributes]); one aggregate query per
+    # relationship triple plus one histogram and one distinct count query per
+    # numeric attribute. Percentiles are interpolated from the histogram and
+    # distinct counts are HyperLogLog estimates, both in bounded server
+    # memory; exact computes them on the server instead, which holds every
+    # value. Non-numeric attributes only get a distinct count with exact.
+    log_section("Attribute profiles")
+    profiles = {}
+    for start, rel, end, attributes in specs:
+        result = run_query(
+            driver,
+            "attribute_profile",
+            start=start,
+            rel=rel,
+            end=end,
+            aggregates=get_attribute_aggregates(attributes, percentiles, exact),
+        )
+        row = result[0]
+        for i, attribute in enumerate(attributes):
+            profile = {
+                "count": row[f"a{i}_count"],
+                "nulls": row["total"] - row[f"a{i}_count"],
+                "distinct": row[f"a{i}_distinct"] if exact else None,
+                "min": row[f"a{i}_min"],
+                "max": row[f"a{i}_max"],
+                "avg": row[f"a{i}_avg"],
+                "stDev": row[f"a{i}_stDev"],
+                "percentiles": {
+                    percentile: row[f"a{i}_p{j}"] if exact else None
+                    for j, percentile in enumerate(percentiles)
+                },
+                "histogram": None,
+                "approximate": not exact,
+            }
+            numeric = isinstance(profile["min"], (int, float)) and not isinstance(profile["min"], bool)
+            if numeric and profile["count"] > 0:
+                if bins:
+                    profile["histogram"] = get_attribute_histogram(
+                        start, rel, end, attribute, profile["min"], profile["max"], driver, bins
+                    )
+                    if not exact:
+                        profile["percentiles"] = get_histogram_percentiles(
+                            *profile["histogram"], percentiles, profile["min"], profile["max"]
+                        )
+                if not exact:
+                    value = f"r.`{attribute}`"
+                    if isinstance(profile["min"], float) or isinstance(profile["max"], float):
+                        # floats are told apart up to DISTINCT_FLOAT_SCALE
+                        value = f"toInteger(round({value} * {DISTINCT_FLOAT_SCALE}))"
+                    profile["distinct"] = get_approximate_distinct_count(
+                        start, rel, end, driver, key=value, precision=precision
+                    )
+            profiles[(start, rel, end, attribute)] = profile
+            log_to_file(f"{start} -> [{rel}] -> {end}  | Attribute: {attribute}\n")
+            log_to_file(
+                f"Min: {profile['min']}, Max: {profile['max']}, Avg: {profile['avg']}, stDev: {profile['stDev']}, "
+                f"nulls: {profile['nulls']}, distinct: {profile['distinct']}, percentiles: {profile['percentiles']}"
+                f"{' (approximate)' if profile['approximate'] else ''}\n",
+                key=f"{start} -> [{rel}] -> {end} | {attribute}",
+                value=profile,
+            )
+    return profiles
+
+
+@profiled
+def get_all_node_counts(labels, driver, use_wccComponent=False, stats_store=None):
+    log_section("Node counts")
+    if stats_store is not None:
+        # counts that get stored must not come from a QueryCache
+        driver = stats_store.driver
+    counts = {}
+    for label in labels:
+        count = None
+        if stats_store is not None:
+            count = stats_store.get_node_count(label, use_wccComponent)
+        if count is not None:
+            log_to_file(f"{label}: {count} \n", key=label, value=count)
+        else:
+            count = get_node_count(label, driver, use_wccComponent)
+            if stats_store is not None:
+                stats_store.put_node_count(label, count, use_wccComponent)
+        counts[label] = count
+    if stats_store is not None:
+        stats_store.save()
+    return counts
+
+
+@profiled
+def get_all_rel_min_max_avg(
+    relationships,
+    driver,
+    use_wccComponent=False,
+    batched=False,
+    stats_store=None,
+    approximate=False,
+    exact_relationships=(),
+    sample_size=10000,
+    histogram=False,
+    distinct_counts=False,
+):
+    # With a stats_store, only triples whose labels or relationship type
+    # changed since the stored run are queried again. With approximate, every
+    # triple not in exact_relationships is estimated from a sample of its
+    # start nodes (get_approximate_rel_min_max_avg, distinct_counts adds its
+    # HyperLogLog node counts); estimates are not stored.
+    # With histogram, exact stats also carry quantiles and a degree histogram.
+    log_section("Number of Relationships")
+    relationships = [tuple(rel) for rel in relationships]
+    stored = {}
+    if stats_store is not None:
+        # stats that get stored must not come from a QueryCache
+        driver = stats_store.driver
+        for rel in relationships:
+            stats = stats_store.get_rel_stats(rel, use_wccComponent)
+            if stats is not None and (not histogram or "histogram" in stats):
+                stored[rel] = stats
+
+    exact_relationships = {tuple(rel) for rel in exact_relationships}
+    estimated = {
+        rel for rel in relationships
+        if approximate and rel not in stored and rel not in exact_relationships
+    }
+
+    computed = {}
+    if batched:
+        triples_by_start = {}
+        for start, rel, end in relationships:
+            if (start, rel, end) not in stored and (start, rel, end) not in estimated:
+                triples_by_start.setdefault(start, []).append((rel, end))
+        for start, triples in triples_by_start.items():
+            computed.update(
+                get_rel_min_max_avg_for_start(start, triples, driver, use_wccComponent, histogram)
+            )
+
+    all_stats = {}
+    for rel in relationships:
+        if rel in stored:
+            stats = stored[rel]
+            log_rel_min_max_avg(rel[0], rel[1], rel[2], stats)
+        elif rel in estimated:
+            stats = get_approximate_rel_min_max_avg(
+                rel[0], rel[1], rel[2], driver, use_wccComponent, sample_size,
+                distinct_counts=distinct_counts,
+            )
+        elif batched:
+            stats = computed[rel]
+            log_rel_min_max_avg(rel[0], rel[1], rel[2], stats)
+        else:
+            stats = get_rel_min_max_avg(
+                rel[0], rel[1], rel[2], driver, use_wccComponent, histogram
+            )
+        if stats_store is not None and rel not in stored and rel not in estimated:
+            stats_store.put_rel_stats(rel, stats, use_wccComponent)
+        all_stats[rel] = stats
+    if stats_store is not None:
+        stats_store.save()
+    return all_stats
+
+
+@profiled
 def get_disease_counts(
     driver,
     top_k=None,
@@ -86,35 +503,29 @@ def get_disease_counts(
     min_occurrence=1, log = False
 ):
     if log:
-        log_to_file("\n")
-        log_to_file(
-            "------------------------- Disease analysis -------------------------\n"
+        log_section("Disease analysis")
+    if name:
+        result = run_query(
+            driver,
+            "disease_count_by_name",
+            {"name": name, "min_occurrence": min_occurrence},
+        )
+    else:
+        result = run_query(
+            driver,
+            "disease_counts",
+            {"min_occurrence": min_occurrence, "top_k": top_k},
+            limit="limit $top_k" if top_k else "",
         )
-    includeControl = False
-    if name == "control":
-        includeControl = True
-
-    query = (
-        """Match (s:Biological_sample) -[r:HAS_DISEASE]-> (b:Disease """
-        + ('{name: "' + name + '"}' if name else "")
-        + """)
-            with count(r) as disease_count, b.name as name
-            where disease_count>= """
-        + str(min_occurrence)
-        + """
-            """
-        + ("" if includeControl else "and b.name <> 'control'")
-        + """
-            return name, disease_count order by disease_count desc """
-        + (f" limit {top_k}" if top_k else "")
-        + ""
-    )
-    print(query)
-    result = request(driver, query)
 
     total_disease_count = len(result)
     if log:
-        log_to_file(f"Total number of diseases: {total_disease_count} \n")
+        log_to_file(
+            f"Total number of diseases: {total_disease_count} \n",
+            key="total_number_of_diseases",
+            value=total_disease_count,
+            record_type="total_number_of_diseases",
+        )
 
         log_to_file("Diseases by count\n")
     index = 0
@@ -123,52 +534,60 @@ def get_disease_counts(
         if disease["disease_count"] < min_occurrence:
             break
         if log:
-            log_to_file(f"{index}, {disease['disease_count']} \n")
+            log_to_file(
+                f"{index}, {disease['disease_count']} \n",
+                key=disease["name"],
+                value=disease["disease_count"],
+                record_type="disease_count",
+            )
         index += 1
         disease_counts[disease["name"]] = disease["disease_count"]
     return disease_counts
 
 
+@profiled
 def get_people_analysis(driver):
-    log_to_file("\n")
-    log_to_file("------------------------- People analysis -------------------------\n")
+    log_section("People analysis")
     # sick people
-    query = """Match(b:Disease) <-[r:HAS_DISEASE]-(a:Biological_sample)
-            where b.name <> 'control'
-            return count(distinct a) as sick_people"""
-    result = request(driver, query)
-    log_to_file(f"Number of sick people: {result[0]['sick_people']} \n")
+    result = run_query(driver, "sick_people")
+    log_to_file(
+        f"Number of sick people: {result[0]['sick_people']} \n",
+        key="sick_people",
+        value=result[0]["sick_people"],
+    )
 
     # healthy people
-    query = """Match(b:Disease) <-[r:HAS_DISEASE]-(a:Biological_sample)
-            where b.name = 'control'
-            return count(distinct a) as healthy_people"""
-    result = request(driver, query)
-    log_to_file(f"Number of healthy people: {result[0]['healthy_people']} \n")
+    result = run_query(driver, "healthy_people")
+    log_to_file(
+        f"Number of healthy people: {result[0]['healthy_people']} \n",
+        key="healthy_people",
+        value=result[0]["healthy_people"],
+    )
 
     # without diagnosis
-    query = """Match(a:Biological_sample)
-            where not (a)-[:HAS_DISEASE]->()
-            return count(a) as undiagnosed"""
-    result = request(driver, query)
-    log_to_file(f"Number of people without diagnosis: {result[0]['undiagnosed']} \n")
+    result = run_query(driver, "undiagnosed_people")
+    log_to_file(
+        f"Number of people without diagnosis: {result[0]['undiagnosed']} \n",
+        key="undiagnosed",
+        value=result[0]["undiagnosed"],
+    )
 
 
+@profiled
 def get_all_relationships(driver, use_wccComponent=False):
     wcc_query = "where a.wccComponentId = 0 and b.wccComponentId =0" if use_wccComponent else ""
-    query = f"MATCH (a)-[r]->(b) {wcc_query} RETURN distinct type(r) as relationship, labels(a)[0] as a,  labels(b)[0] as b"
-    result = request(driver, query)
-    print(result)
+    result = stream_query(driver, "all_relationships", wcc_query=wcc_query)
     relationships = []
     for rel in result:
         relationships.append((rel["a"], rel["relationship"], rel["b"]))
+    print(relationships)
     return relationships
 
 
+@profiled
 def get_all_node_types(driver, use_wccComponent=False):
     wcc_query = "where a.wccComponentId = 0" if use_wccComponent else ""
-    query = f"MATCH (a) {wcc_query} RETURN distinct labels(a) as labels"
-    result = request(driver, query)
+    result = run_query(driver, "all_node_types", wcc_query=wcc_query)
     nodeTypes = set()
     for node in result:
         if node["labels"]:
@@ -177,33 +596,29 @@ def get_all_node_types(driver, use_wccComponent=False):
     return nodeTypes
 
 
+@profiled
 def get_missing_ensamble_id_analysis(driver):
-    query = """MATCH (b:Biological_sample)-[r:HAS_DAMAGE]->(g:Gene)
-                WHERE g.synonyms[1]=""
-                RETURN 
-                    count(DISTINCT b) AS number_of_biological_samples, 
-                    count(DISTINCT g) AS number_of_genes, 
-                    count(r) AS number_of_relationships"""
-    result = request(driver, query)
-    log_to_file(
-        f"------------------------- Missing Ensamble ID analysis -------------------------\n"
-    )
+    result = run_query(driver, "missing_ensamble_id")
+    log_section("Missing Ensamble ID analysis")
     log_to_file(
-        f"Number of genes without ensamble id: {result[0]['number_of_genes']}\n"
+        f"Number of genes without ensamble id: {result[0]['number_of_genes']}\n",
+        key="number_of_genes",
+        value=result[0]["number_of_genes"],
     )
     log_to_file(
-        f"Number of biological samples connected to genes without ensamble id: {result[0]['number_of_biological_samples']}\n"
+        f"Number of biological samples connected to genes without ensamble id: {result[0]['number_of_biological_samples']}\n",
+        key="number_of_biological_samples",
+        value=result[0]["number_of_biological_samples"],
     )
     log_to_file(
-        f"Number of relationships between a sample and a gene withou ensamble id: {result[0]['number_of_relationships']}\n"
+        f"Number of relationships between a sample and a gene withou ensamble id: {result[0]['number_of_relationships']}\n",
+        key="number_of_relationships",
+        value=result[0]["number_of_relationships"],
     )
 
+@profiled
 def get_icd10_disease_map(driver):
-    query = """MATCH (d:Disease)
-        WHERE d.synonyms IS NOT NULL AND size(d.synonyms) > 0
-        UNWIND d.synonyms AS synonym
-        RETURN d.name AS name, synonym"""
-    result = request(driver, query)
+    result = stream_query(driver, "disease_synonyms")
     icd10map = {}
     for disease in result:
         if disease["synonym"].startswith("ICD10"):
@@ -213,26 +628,137 @@ def get_icd10_disease_map(driver):
             icd10map[disease["name"]] = disease["synonym"]
     return icd10map
 
-def collect_by_icd10(disease_counts, icd10map):
-    icd10DiseaseCounts = {}
-
-    for disease in disease_counts:
-        if disease in icd10map:
-            if icd10DiseaseCounts.get(icd10map[disease]):
-                icd10DiseaseCounts[icd10map[disease]] = max(icd10DiseaseCounts[icd10map[disease]], disease_counts[disease])
-            else:
-                icd10DiseaseCounts[icd10map[disease]] = disease_counts[disease]
+# ICD-10-CM chapters, the Disease synonyms are ICD10CM codes
+ICD10_CHAPTERS = [
+    ("Chapter I", "A00", "B99"),
+    ("Chapter II", "C00", "D49"),
+    ("Chapter III", "D50", "D89"),
+    ("Chapter IV", "E00", "E89"),
+    ("Chapter V", "F01", "F99"),
+    ("Chapter VI", "G00", "G99"),
+    ("Chapter VII", "H00", "H59"),
+    ("Chapter VIII", "H60", "H95"),
+    ("Chapter IX", "I00", "I99"),
+    ("Chapter X", "J00", "J99"),
+    ("Chapter XI", "K00", "K95"),
+    ("Chapter XII", "L00", "L99"),
+    ("Chapter XIII", "M00", "M99"),
+    ("Chapter XIV", "N00", "N99"),
+    ("Chapter XV", "O00", "O9A"),
+    ("Chapter XVI", "P00", "P96"),
+    ("Chapter XVII", "Q00", "Q99"),
+    ("Chapter XVIII", "R00", "R99"),
+    ("Chapter XIX", "S00", "T88"),
+    ("Chapter XX", "V00", "Y99"),
+    ("Chapter XXI", "Z00", "Z99"),
+    ("Chapter XXII", "U00", "U85"),
+]
+
+
+def merge_by_group(keys, values, aggregate="max"):
+    # Vectorized groupby of values by keys, groups in order of first appearance
+    keys = np.asarray(keys, dtype=object)
+    values = np.asarray(values, dtype=np.int64)
+    if len(keys) == 0:
+        return {}
+    groups, first, inverse = np.unique(keys.astype(str), return_index=True, return_inverse=True)
+    merged = np.zeros(len(groups), dtype=np.int64)
+    if aggregate == "max":
+        np.maximum.at(merged, inverse, values)
+    else:
+        np.add.at(merged, inverse, values)
+    order = np.argsort(first, kind="stable")
+    return {str(groups[i]): int(merged[i]) for i in order}
+
+
+def get_icd10_categories(codes):
+    # "ICD10CM:K21.9" -> "K21"
+    return np.array([code.rsplit(":", 1)[-1][:3].upper() for code in codes], dtype=str)
+
+
+def get_range_groups(categories, ranges):
+    # ranges are (name, first category, last category) tuples such as
+    # ICD10_CHAPTERS or a table of ICD10 blocks; None outside every range
+    ranges = sorted(ranges, key=lambda item: item[1])
+    starts = np.array([start for _, start, _ in ranges], dtype=str)
+    ends = np.array([end for _, _, end in ranges], dtype=str)
+    names = np.array([name for name, _, _ in ranges], dtype=object)
+    index = np.searchsorted(starts, categories, side="right") - 1
+    inside = (index >= 0) & (categories <= ends[np.maximum(index, 0)])
+    return np.where(inside, names[np.maximum(index, 0)], None)
+
+
+def roll_up_icd10(groups, is_icd10, counts, level="code", blocks=None, aggregate="max"):
+    # level is "code", "category" (e.g. K21), "block" (needs a blocks ranges
+    # table) or "chapter"; groups that are not ICD10 codes, or fall outside
+    # every range, keep their own name. Codes outside every range are logged.
+    groups = np.asarray(groups, dtype=object)
+    is_icd10 = np.asarray(is_icd10, dtype=bool)
+    keys = groups.copy()
+    if level != "code" and is_icd10.any():
+        categories = get_icd10_categories(groups[is_icd10])
+        if level == "category":
+            rolled = categories.astype(object)
+        elif level == "chapter":
+            rolled = get_range_groups(categories, ICD10_CHAPTERS)
+        elif level == "block":
+            if blocks is None:
+                raise ValueError("Rolling up to ICD10 blocks needs a blocks ranges table")
+            rolled = get_range_groups(categories, blocks)
         else:
-            icd10DiseaseCounts[disease] = disease_counts[disease]
-    log_to_file("--------------- Diseases by ICD10 code or disease ---------------")
-    for i,disease in enumerate(icd10DiseaseCounts):
-        log_to_file(f"{i}, {icd10DiseaseCounts[disease]}s\n") 
+            raise ValueError(f"Unknown ICD10 level {level}")
+        found = np.array([group is not None for group in rolled], dtype=bool)
+        if not found.all():
+            unmapped = sorted(set(groups[is_icd10][~found]))
+            log_to_file(
+                f"ICD10 codes outside every {level} range: {', '.join(unmapped)}\n",
+                key=f"unmapped ICD10 {level}",
+                value=unmapped,
+                record_type="unmapped_icd10",
+            )
+        keys[is_icd10] = np.where(found, rolled, groups[is_icd10])
+    return merge_by_group(keys, counts, aggregate)
+
+
+def get_icd10_disease_counts(driver, min_occurrence=1):
+    # ICD10 synonyms are filtered and max-merged per code in the database;
+    # roll the result up with roll_up_icd10 without querying again.
+    result = run_query(driver, "icd10_disease_counts", {"min_occurrence": min_occurrence})
+    groups = [row["disease_group"] for row in result]
+    is_icd10 = [row["is_icd10"] for row in result]
+    counts = [row["disease_count"] for row in result]
+    return groups, is_icd10, counts
+
+
+@profiled
+def get_icd10_grouped_counts(driver, levels=("code",), min_occurrence=1, blocks=None, aggregate="max"):
+    groups, is_icd10, counts = get_icd10_disease_counts(driver, min_occurrence)
+    grouped = {}
+    for level in levels:
+        grouped[level] = roll_up_icd10(groups, is_icd10, counts, level, blocks, aggregate)
+        log_group_counts(f"Diseases by ICD10 {level} or disease", grouped[level])
+    return grouped
+
+
+@profiled
+def collect_by_icd10(disease_counts, icd10map):
+    diseases = list(disease_counts.keys())
+    keys = [icd10map.get(disease, disease) for disease in diseases]
+    icd10DiseaseCounts = merge_by_group(keys, [disease_counts[disease] for disease in diseases])
+    log_group_counts("Diseases by ICD10 code or disease", icd10DiseaseCounts)
     return icd10DiseaseCounts
 
+
+def log_group_counts(title, group_counts):
+    log_section(title)
+    for i,disease in enumerate(group_counts):
+        log_to_file(f"{i}, {group_counts[disease]}s\n", key=disease, value=group_counts[disease])
+
+
 def get_graph_structure_overview():
-    driver = GraphDatabase.driver(
-        utils.NEO4J_URL, auth=(utils.NEO4J_LOGIN, utils.NEO4J_PASSWORD)
-    )
+    start_profiling()
+    session_manager = SessionManager()
+    driver = QueryCache(session_manager)
     clear_log_file()
     log_to_file("Graph structure overview\n")
 
@@ -240,6 +766,7 @@ def get_graph_structure_overview():
     
     # disease_counts = get_disease_counts(driver, min_occurrence=1)
     # collect_by_icd10(disease_counts, icd10map)
+    # get_icd10_grouped_counts(driver, levels=("code", "category", "chapter"))
 
     use_wccComponent = False
 
@@ -261,11 +788,26 @@ def get_graph_structure_overview():
     # relationships = [('Tissue', 'HAS_PARENT', 'Tissue'), ('Biological_process', 'HAS_PARENT', 'Biological_process'), ('Disease', 'HAS_PARENT', 'Disease'), ('Molecular_function', 'HAS_PARENT', 'Molecular_function'), ('Cellular_component', 'HAS_PARENT', 'Cellular_component'), ('Modification', 'HAS_PARENT', 'Modification'), ('Phenotype', 'HAS_PARENT', 'Phenotype'), ('Gene', 'ASSOCIATED_WITH', 'Disease'), ('Experimental_factor', 'HAS_PARENT', 'Experimental_factor'), ('Experimental_factor', 'MAPS_TO', 'Disease'), ('Transcript', 'LOCATED_IN', 'Chromosome'), ('Experimental_factor', 'MAPS_TO', 'Phenotype'), ('Gene', 'TRANSCRIBED_INTO', 'Transcript'), ('Peptide', 'BELONGS_TO_PROTEIN', 'Protein'), ('Gene', 'TRANSLATED_INTO', 'Protein'), ('Transcript', 'TRANSLATED_INTO', 'Protein'), ('Protein', 'ASSOCIATED_WITH', 'Cellular_component'), ('Protein', 'ASSOCIATED_WITH', 'Molecular_function'), ('Protein', 'ASSOCIATED_WITH', 'Biological_process'), ('Modified_protein', 'HAS_MODIFICATION', 'Modification'), ('Protein', 'HAS_MODIFIED_SITE', 'Modified_protein'), ('Peptide', 'HAS_MODIFIED_SITE', 'Modified_protein'), ('Modified_protein', 'IS_SUBSTRATE_OF', 'Protein'), ('Protein', 'IS_SUBUNIT_OF', 'Complex'), ('Complex', 'ASSOCIATED_WITH', 'Biological_process'), ('Protein', 'CURATED_INTERACTS_WITH', 'Protein'), ('Protein', 'COMPILED_INTERACTS_WITH', 'Protein'), ('Protein', 'ACTS_ON', 'Protein'), ('Protein', 'ASSOCIATED_WITH', 'Disease'), ('Protein', 'IS_BIOMARKER_OF_DISEASE', 'Disease'), ('Protein', 'IS_QCMARKER_IN_TISSUE', 'Tissue'), ('Clinical_variable', 'HAS_PARENT', 'Clinical_variable'), ('Experimental_factor', 'MAPS_TO', 'Clinical_variable'), ('Gene', 'LOCATED_IN', 'Chromosome'), ('Known_variant', 'VARIANT_FOUND_IN_CHROMOSOME', 'Chromosome'), ('Known_variant', 'VARIANT_FOUND_IN_GENE', 'Gene'), ('Known_variant', 'VARIANT_FOUND_IN_PROTEIN', 'Protein'), ('Known_variant', 'CURATED_AFFECTS_INTERACTION_WITH', 'Protein'), ('Clinically_relevant_variant', 'ASSOCIATED_WITH', 'Disease'), ('Protein', 'DETECTED_IN_PATHOLOGY_SAMPLE', 'Disease'), ('Known_variant', 'VARIANT_IS_CLINICALLY_RELEVANT', 'Clinically_relevant_variant'), ('Disease', 'MENTIONED_IN_PUBLICATION', 'Publication'), ('Tissue', 'MENTIONED_IN_PUBLICATION', 'Publication'), ('Protein', 'MENTIONED_IN_PUBLICATION', 'Publication'), ('Disease', 'MAPS_TO', 'Clinical_variable'), ('Cellular_component', 'MENTIONED_IN_PUBLICATION', 'Publication'), ('Modified_protein', 'MENTIONED_IN_PUBLICATION', 'Publication'), ('Protein', 'ASSOCIATED_WITH', 'Tissue'), ('Functional_region', 'FOUND_IN_PROTEIN', 'Protein'), ('Functional_region', 'MENTIONED_IN_PUBLICATION', 'Publication'), ('Metabolite', 'ASSOCIATED_WITH', 'Protein'), ('Metabolite', 'ASSOCIATED_WITH', 'Disease'), ('Known_variant', 'VARIANT_FOUND_IN_GWAS', 'GWAS_study'), ('GWAS_study', 'STUDIES_TRAIT', 'Experimental_factor'), ('Protein', 'ANNOTATED_IN_PATHWAY', 'Pathway'), ('Metabolite', 'ANNOTATED_IN_PATHWAY', 'Pathway'), ('GWAS_study', 'PUBLISHED_IN', 'Publication'), ('Project', 'HAS_ENROLLED', 'Subject'), ('Biological_sample', 'BELONGS_TO_SUBJECT', 'Subject'), ('Biological_sample', 'HAS_DISEASE', 'Disease'), ('Biological_sample', 'HAS_PHENOTYPE', 'Phenotype'), ('Biological_sample', 'HAS_PROTEIN', 'Protein'), ('Biological_sample', 'HAS_DAMAGE', 'Gene')]
     # relationships = relationships[34:]
 
-    get_all_rel_min_max_avg(relationships, driver, use_wccComponent)
+    # the stats pass and the fingerprints of the StatsStore bypass the
+    # QueryCache, whose fingerprint misses reloads with unchanged counts
+    get_all_rel_min_max_avg(
+        relationships,
+        session_manager,
+        use_wccComponent,
+        batched=True,
+        stats_store=StatsStore(session_manager),
+    )
 
     # get_people_analysis(driver)
     # get_missing_ensamble_id_analysis(driver)
 
+    print(f"Total query time: {session_manager.total_time():.2f}s, cache hits: {driver.hits}")
+    driver.close()
+    profiler = stop_profiling()
+    profiler.report()
+    profiler.to_json("./profile_graph_structure.json")
+    profiler.to_csv("./profile_graph_structure")
+
 
 if __name__ == "__main__":
     get_graph_structure_overview()
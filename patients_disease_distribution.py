@@ -1,41 +1,82 @@
 # %%
+import json
+import os
 import matplotlib.pyplot as plt
 from random import randrange
-import matplotlib.pyplot as plt
 import re
 
 LOG_FILE = "log_hauner.txt"
-
-
-def get_disease_distribution(log_file_path):
+LOG_JSON_FILE = "log_hauner.jsonl"
+DISEASE_SECTION = "Disease analysis"
+SECTION_HEADER = "-------------------------"
+
+
+def load_disease_counts_from_json_log(json_log_path):
+    # Reads the disease_count records of the last "Disease analysis" section
+    # of a structured log (utils.LogSink) line by line; other records logged
+    # in that section are skipped.
+    total_number_of_diseases = None
+    counts = []
+    with open(json_log_path, "r") as file:
+        for line in file:
+            record = json.loads(line)
+            if record["section"] != DISEASE_SECTION:
+                continue
+            if record.get("type") == "total_number_of_diseases":
+                total_number_of_diseases = record["value"]
+                counts = []
+            elif record.get("type") == "disease_count":
+                counts.append(int(record["value"]))
+    return total_number_of_diseases, counts
+
+
+def load_disease_counts_from_log(log_file_path):
+    # Fallback for plain text logs: streams the "<index>, <count>" lines of
+    # the last "Disease analysis" section instead of reading the whole file.
+    total_number_of_diseases = None
+    counts = []
+    in_section = False
+    with open(log_file_path, "r") as file:
+        for line in file:
+            if line.startswith(SECTION_HEADER):
+                in_section = DISEASE_SECTION in line
+                if in_section:
+                    total_number_of_diseases = None
+                    counts = []
+                continue
+            if not in_section:
+                continue
+            total = re.match(r"Total number of diseases:\s*(\d+)", line)
+            if total:
+                total_number_of_diseases = int(total.group(1))
+                continue
+            disease = re.match(r"(\d+),\s*(\d+)\s*$", line)
+            if disease:
+                counts.append(int(disease.group(2)))
+    return total_number_of_diseases, counts
+
+
+def load_disease_counts(log_file_path=LOG_FILE, json_log_path=LOG_JSON_FILE):
+    if json_log_path and os.path.exists(json_log_path):
+        return load_disease_counts_from_json_log(json_log_path)
+    return load_disease_counts_from_log(log_file_path)
+
+
+def get_disease_distribution(log_file_path=LOG_FILE, json_log_path=LOG_JSON_FILE):
     try:
-        with open(log_file_path, "r") as file:
-            log_content = file.read()
+        total_number_of_diseases, counts = load_disease_counts(log_file_path, json_log_path)
     except FileNotFoundError:
         print(f"File not found: {log_file_path}")
         return
 
-    disease_section = re.search(
-        r"------------------------- Disease analysis -------------------------.*?-------------------------",
-        log_content,
-        re.S,
-    )
-
-    if not disease_section:
+    if not counts:
         print("Disease analysis section not found in the log file.")
         return
 
-    total_number_of_diseases = int(
-        re.search(r"Total number of diseases:\s*(\d+)", log_content).group(1)
-    )
     if not total_number_of_diseases:
         print("Total number of diseases not found.")
         return
 
-    disease_section_text = disease_section.group(0)
-    disease_data = re.findall(r"(.+?),\s*(\d+)", disease_section_text)
-    counts = [int(d[1]) for d in disease_data]
-
     hidden_disease_counts = get_hidden_diseases(total_number_of_diseases, counts)
     plot_disease_distribution(counts, hidden_disease_counts)
 
@@ -87,6 +128,7 @@ def get_hidden_diseases(total_number_of_diseases, counts):
     return hidden_disease_counts
 
 
-get_disease_distribution(LOG_FILE)
+if __name__ == "__main__":
+    get_disease_distribution(LOG_FILE, LOG_JSON_FILE)
 
 # %%
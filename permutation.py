@@ -0,0 +1,202 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+
+
+# differences[i, j] is the observed share of samples of diseases[i] with
+# features[j] minus the share in the control (control samples that also have
+# diseases[i] count for the disease only); p_values[i, j] the two-sided
+# empirical p-value (1 + exceedances) / (1 + permutations) of that difference
+# under the null that the labels are exchangeable within disease + control.
+PermutationResult = namedtuple(
+    "PermutationResult", ["diseases", "features", "differences", "p_values", "permutations"]
+)
+
+
+def get_membership(cohort_index, disease_names, control_name="control"):
+    # Samples with any of the diseases or the control and their
+    # pool x (diseases + control) membership matrix.
+    membership = cohort_index.get_membership(list(disease_names) + [control_name])
+    pool = np.flatnonzero(np.diff(membership.indptr))
+    return pool, membership[pool]
+
+
+def get_differences(counts, totals, sizes, block_sizes):
+    # counts: diseases x features in the disease groups, totals the same
+    # counts over each disease + control block; the control group of a block
+    # is whatever is not in its disease group
+    disease_shares = counts / np.maximum(sizes, 1)[:, None]
+    control_shares = (totals - counts) / np.maximum(block_sizes - sizes, 1)[:, None]
+    return disease_shares - control_shares
+
+
+def get_blocks(membership, features):
+    # The disease + control block of every disease as the disease entries
+    # outside the control, grouped by disease, plus the control samples
+    # shared by all blocks; sizes are those of the disease groups.
+    diseases = membership[:, :-1].tocsc()
+    is_control = membership[:, -1].toarray().ravel() > 0
+    entry_diseases = np.repeat(np.arange(diseases.shape[1]), np.diff(diseases.indptr))
+    outside = ~is_control[diseases.indices]
+    entry_diseases = entry_diseases[outside]
+    control = np.flatnonzero(is_control)
+    # feature counts of each block, disease samples in the control once
+    totals = (
+        (diseases.T @ features).toarray()
+        + np.asarray(features[control].sum(axis=0))
+        - (diseases.T @ features.multiply(is_control[:, None]).tocsr()).toarray()
+    )
+    return {
+        "samples": diseases.indices[outside],
+        "entry_diseases": entry_diseases,
+        "starts": np.searchsorted(entry_diseases, np.arange(diseases.shape[1])),
+        "control": control,
+        "sizes": np.diff(diseases.indptr),
+        "block_sizes": np.bincount(entry_diseases, minlength=diseases.shape[1]) + len(control),
+        "totals": totals.astype(np.float32),
+    }
+
+
+_worker = {}
+
+
+def _init_permutation_worker(blocks, features, observed):
+    # runs once per worker process, so the matrices are pickled once per
+    # worker instead of once per batch
+    _worker.update(blocks)
+    _worker["features"] = features
+    # float32 like the counts, the tolerance absorbs its rounding
+    _worker["observed"] = (np.abs(observed) - 1e-6).astype(np.float32)
+
+
+def _count_exceedances(seed, permutations):
+    # Every permutation ranks the whole pool once, shared by all diseases.
+    # The permuted disease group of a disease is the sizes[i] lowest ranked
+    # samples of its block: a binary search finds the rank threshold of
+    # every block at once, and the permuted counts of all diseases come from
+    # one sparse product with the features.
+    rng = np.random.default_rng(seed)
+    samples = _worker["samples"]
+    entry_diseases = _worker["entry_diseases"]
+    starts = _worker["starts"]
+    control = _worker["control"]
+    sizes = _worker["sizes"]
+    features = _worker["features"]
+    count = features.shape[0]
+    diseases = np.arange(len(sizes))
+    exceedances = np.zeros(_worker["observed"].shape, dtype=np.int32)
+    for _ in range(permutations):
+        rank = rng.permutation(count)
+        # entries ordered by disease, then rank
+        keys = entry_diseases * count + rank[samples]
+        order = np.argsort(keys)
+        keys = keys[order]
+        control_by_rank = control[np.argsort(rank[control])]
+        control_ranks = rank[control_by_rank]
+
+        def get_ranked_below(threshold):
+            return (
+                np.searchsorted(keys, diseases * count + threshold, side="right") - starts,
+                np.searchsorted(control_ranks, threshold, side="right"),
+            )
+
+        low = np.zeros(len(sizes), dtype=np.int64)
+        high = np.full(len(sizes), count - 1, dtype=np.int64)
+        while np.any(low < high):
+            middle = (low + high) // 2
+            enough = sum(get_ranked_below(middle)) >= sizes
+            high = np.where(enough, middle, high)
+            low = np.where(enough, low, middle + 1)
+        from_diseases = np.where(sizes > 0, get_ranked_below(low)[0], 0)
+        from_control = sizes - from_diseases
+
+        ordered_diseases = entry_diseases[order]
+        in_group = np.arange(len(order)) - starts[ordered_diseases] < from_diseases[ordered_diseases]
+        control_positions = np.arange(from_control.sum()) - np.repeat(
+            np.cumsum(from_control) - from_control, from_control
+        )
+        rows = np.concatenate([ordered_diseases[in_group], np.repeat(diseases, from_control)])
+        columns = np.concatenate([samples[order][in_group], control_by_rank[control_positions]])
+        groups = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(sizes), count)
+        )
+        differences = get_differences(
+            (groups @ features).toarray(), _worker["totals"], sizes, _worker["block_sizes"]
+        )
+        exceedances += np.abs(differences) >= _worker["observed"]
+    return exceedances
+
+
+def permutation_test(
+    cohort_index,
+    relationship_type,
+    node_type,
+    disease_names=None,
+    control_name="control",
+    permutations=1000,
+    batch_size=100,
+    seed=0,
+    processes=1,
+):
+    # Label permutation null of the disease vs control share differences of
+    # every feature, from the sample x feature incidence of a CohortIndex.
+    # The labels of a disease are only exchanged with those of the control,
+    # so each test is disease vs control, not vs every diagnosed sample.
+    # Batches of batch_size permutations get their own seed spawned from
+    # seed, so results only depend on seed and batch_size, not on processes.
+    if disease_names is None:
+        disease_names = [name for name in cohort_index.disease_names if name != control_name]
+    cohort_index.snapshot.check_relationship(relationship_type, node_type)
+    pool, membership = get_membership(cohort_index, disease_names, control_name)
+    features = cohort_index.snapshot.get_matrix(relationship_type)[pool]
+    # a sample counts once per feature, like the share of samples
+    features = (features > 0).astype(np.float32).tocsr()
+    seen = np.unique(features.indices)
+    features = features[:, seen]
+
+    blocks = get_blocks(membership, features)
+    observed = get_differences(
+        (membership[:, :-1].T @ features).toarray(),
+        blocks["totals"],
+        blocks["sizes"],
+        blocks["block_sizes"],
+    )
+
+    batches = [batch_size] * (permutations // batch_size)
+    if permutations % batch_size:
+        batches.append(permutations % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    exceedances = np.zeros(observed.shape, dtype=np.int64)
+    if processes == 1:
+        _init_permutation_worker(blocks, features, observed)
+        for batch_seed, count in zip(seeds, batches):
+            exceedances += _count_exceedances(batch_seed, count)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_permutation_worker,
+            initargs=(blocks, features, observed),
+        ) as executor:
+            for result in executor.map(_count_exceedances, seeds, batches):
+                exceedances += result
+
+    names = cohort_index.snapshot.names[node_type]
+    return PermutationResult(
+        diseases=list(disease_names),
+        features=[names[j] for j in seen],
+        differences=observed,
+        p_values=(1 + exceedances) / (1 + permutations),
+        permutations=permutations,
+    )
+
+
+def get_permutation_p_values(result, disease_name):
+    # {feature: (difference, p-value)} of one disease, features seen in the
+    # disease or the control only
+    i = result.diseases.index(disease_name)
+    return {
+        feature: (float(result.differences[i, j]), float(result.p_values[i, j]))
+        for j, feature in enumerate(result.features)
+        if result.differences[i, j] != 0 or result.p_values[i, j] < 1
+    }
@@ -1,13 +1,72 @@
 import matplotlib.pyplot as plt
 from utils import percentage_sections, get_disease_folder_name
 import os
+import numpy as np
 from matplotlib.patches import Patch
 
+# In batch mode plots render on the Agg backend, never call plt.show(), are
+# always saved (disease plots to the disease folder) and reuse one figure per
+# plot kind.
+batch_mode = False
+_figures = {}
+# graph structure plots are not per disease
+GRAPH_STRUCTURE_FOLDER = "./graph_structure_plots"
+
+
+def set_batch_mode(enabled=True):
+    global batch_mode
+    batch_mode = enabled
+    if enabled:
+        plt.switch_backend("Agg")
+    else:
+        for fig in _figures.values():
+            plt.close(fig)
+        _figures.clear()
+
+
+def get_edges(count):
+    # one unit-wide step per node, drawn as a single filled path instead of
+    # one bar patch per node
+    return np.arange(count + 1) - 0.5
+
+
+def to_positions(values_by_node, positions):
+    values = np.zeros(len(positions))
+    for node, value in values_by_node.items():
+        values[positions[node]] = value
+    return values
+
+
+def get_figure(kind):
+    if not batch_mode:
+        return plt.subplots()
+    if kind not in _figures:
+        _figures[kind] = plt.subplots()
+    fig, ax = _figures[kind]
+    fig.texts.clear()
+    ax.clear()
+    return fig, ax
+
+
+def finish_figure(fig, disease_name, file_name, save_plot):
+    save_figure(fig, get_disease_folder_name(disease_name), file_name, save_plot)
+
+
+def save_figure(fig, folder_name, file_name, save_plot):
+    if not batch_mode:
+        plt.show()
+    if save_plot or batch_mode:
+        if not os.path.exists(folder_name):
+            os.makedirs(folder_name)
+        fig.savefig(f"{folder_name}/{file_name}")
+    if not batch_mode:
+        plt.close(fig)
+
 def plot_common_group_for_disease(
     common_group, disease_name, total_association, disease_count, node_type
 ):
 
-    fig, ax = plt.subplots()
+    fig, ax = get_figure("common_group")
 
     total_associations_count = total_association
     sorted_common_group = dict(
@@ -22,14 +81,14 @@ def plot_common_group_for_disease(
     ax.set_xlabel(node_type)
     ax.set_ylabel("Percentage of occurrences")
     ax.set_xticks([])
-    ax.bar(percentages.keys(), percentages.values())
+    ax.stairs(list(percentages.values()), get_edges(len(percentages)), fill=True)
 
     info_text = (
         f"Total Associations: {total_associations_count}\nSamples: {disease_count}"
     )
-    plt.gcf().text(0.6, 0.8, info_text, fontsize=10, verticalalignment="top")
+    fig.text(0.6, 0.8, info_text, fontsize=10, verticalalignment="top")
 
-    plt.show()
+    finish_figure(fig, disease_name, f"occ_{node_type}_plot.png", save_plot=False)
 
 
 def plot_common_group_comparison(
@@ -40,41 +99,41 @@ def plot_common_group_comparison(
     save_plot,
     disease_name,
 ):
-    print("Percentage diff", percentage_diff)
+    if not batch_mode:
+        print("Percentage diff", percentage_diff)
     percentage_diff = dict(
         sorted(percentage_diff.items(), key=lambda item: item[1], reverse=True)
     )
-    fig, ax = plt.subplots()
+    # numeric x positions in the sorted order of percentage_diff, which
+    # contains every node of both maps
+    positions = {node: i for i, node in enumerate(percentage_diff)}
+    fig, ax = get_figure("common_group_comparison")
     ax.set_title(f"Occurrences of {node_type}")
     ax.set_xlabel(node_type)
     ax.set_ylabel("Percentage of occurrences")
     ax.set_xticks([])
+    ax.set_xlim(-0.5, max(len(positions), 1) - 0.5)
 
-    ax.bar(
-        percentage_diff.keys(),
-       [0] * len(percentage_diff),
-    )
-    ax.bar(
-        percentage_map_disease.keys(),
-        percentage_map_disease.values(),
+    edges = get_edges(len(positions))
+    ax.stairs(
+        to_positions(percentage_map_disease, positions),
+        edges,
+        fill=True,
         label=disease_name,
         color="blue",
         alpha=0.5,
     )
-    ax.bar(
-        percentage_map_control.keys(),
-        percentage_map_control.values(),
+    ax.stairs(
+        to_positions(percentage_map_control, positions),
+        edges,
+        fill=True,
         label="Control",
         color="orange",
         alpha=0.5,
     )
-    colors = ['green' if value > 0 else 'red' for value in percentage_diff.values()]
-    ax.bar(
-        percentage_diff.keys(),
-        percentage_diff.values(),
-        color=colors,
-        alpha=1,
-    )
+    diff_values = np.fromiter(percentage_diff.values(), dtype=float, count=len(percentage_diff))
+    ax.stairs(np.where(diff_values > 0, diff_values, 0), edges, fill=True, color="green")
+    ax.stairs(np.where(diff_values > 0, 0, diff_values), edges, fill=True, color="red")
 
     number_of_key_disease = len(percentage_map_disease)
 
@@ -106,15 +165,7 @@ def plot_common_group_comparison(
     ]
 
     ax.legend(handles=legend_elements)
-    plt.show()
-
-    if save_plot:
-        folder_name = get_disease_folder_name(disease_name)
-        plot_file_name = f"{folder_name}/occ_diff_{node_type}_plot.png"
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
-        fig.savefig(plot_file_name)
-        plt.close(fig)
+    finish_figure(fig, disease_name, f"occ_diff_{node_type}_plot.png", save_plot)
 
 
 def plot_occ_diff_count(
@@ -123,7 +174,7 @@ def plot_occ_diff_count(
     node_type,
     save_plot=False,
 ):
-    fig, ax = plt.subplots()
+    fig, ax = get_figure("occ_diff_count")
     ax.set_title(f"Percentage Difference in Occurrences of {node_type}s for {disease_name}")
     ax.set_xlabel("Percentage Difference Range")
     ax.set_ylabel("Count")
@@ -143,13 +194,35 @@ def plot_occ_diff_count(
     x_labels.append(label)
     counts.append(section_count_map.get(1, 0))
 
-    ax.bar(x_labels, counts)
+    positions = np.arange(len(x_labels))
+    ax.bar(positions, counts)
+    ax.set_xticks(positions)
     ax.set_xticklabels(x_labels, rotation=90)
 
-    plt.show()
-    if save_plot:
-        folder_name = get_disease_folder_name(disease_name)
-        plot_file_name = f"{folder_name}/occ_count_percentage_{node_type}_plot.png"
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
-        fig.savefig(plot_file_name)    
\ No newline at end of file
+    finish_figure(fig, disease_name, f"occ_count_percentage_{node_type}_plot.png", save_plot)    
+
+def plot_degree_histogram(stats, start, rel, end, save_plot=False, folder_name=GRAPH_STRUCTURE_FOLDER):
+    # stats as returned by graph_structure.get_rel_min_max_avg(histogram=True);
+    # log-binned counts on a log scale so hub nodes stay visible.
+    fig, ax = get_figure("degree_histogram")
+    histogram = stats["histogram"]
+    edges = histogram["edges"]
+    labels = [
+        f"{edges[i]}" if edges[i + 1] - edges[i] <= 1 else f"{edges[i]}-{edges[i + 1] - 1}"
+        for i in range(len(histogram["counts"]))
+    ]
+    positions = np.arange(len(labels))
+    ax.bar(positions, histogram["counts"])
+    ax.set_yscale("log")
+    ax.set_xticks(positions)
+    ax.set_xticklabels(labels, rotation=90)
+    ax.set_title(f"Degree distribution of {start} -> [{rel}] -> {end}")
+    ax.set_xlabel(f"{rel} relationships per {start}")
+    ax.set_ylabel(f"Number of {start} nodes")
+    info_text = "\n".join(
+        [f"p{float(q) * 100:g}: {value}" for q, value in stats["quantiles"].items()]
+        + [f"max: {stats['max']}"]
+    )
+    ax.text(0.97, 0.97, info_text, transform=ax.transAxes, ha="right", va="top")
+    fig.tight_layout()
+    save_figure(fig, folder_name, f"degree_{start}_{rel}_{end}_plot.png", save_plot)
@@ -0,0 +1,247 @@
+import csv
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+PROFILE_FILE = "./profile"
+# frames in these files are skipped when looking for the call site of a query
+_INTERNAL_FILES = {"queries.py", "profiler.py", "utils.py", "contextlib.py"}
+
+active_profiler = None
+
+
+class Profiler:
+    # Records every catalog query (run_query / stream_query) with its call
+    # site, wall time, rows and, when the driver reports it, the server's
+    # result_available_after / result_consumed_after and PROFILE db hits; and
+    # every @profiled analysis function with its wall time split into query
+    # and client-side post-processing time.
+    def __init__(self, profile_queries=False):
+        self.profile_queries = profile_queries
+        self.queries = []
+        self.functions = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _frames(self):
+        if not hasattr(self._local, "frames"):
+            self._local.frames = []
+        return self._local.frames
+
+    @property
+    def _open_queries(self):
+        if not hasattr(self._local, "queries"):
+            self._local.queries = []
+        return self._local.queries
+
+    def get_call_site(self):
+        if self._frames:
+            return self._frames[-1]["call_site"]
+        frame = sys._getframe(1)
+        while frame is not None and os.path.basename(frame.f_code.co_filename) in _INTERNAL_FILES:
+            frame = frame.f_back
+        if frame is None:
+            return None
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+    def start_query(self, name, text=None):
+        # text is the Cypher the query runs, to match server summaries to it
+        record = {
+            "query": name,
+            "call_site": self.get_call_site(),
+            "wall": 0.0,
+            "rows": 0,
+            "available_after": None,
+            "consumed_after": None,
+            "db_hits": None,
+        }
+        self._open_queries.append((record, text))
+        return record
+
+    def end_query(self, record, elapsed):
+        record["wall"] += elapsed
+        for frame in self._frames:
+            frame["query_time"] += elapsed
+        for i, (open_record, _) in enumerate(self._open_queries):
+            if open_record is record:
+                del self._open_queries[i]
+                with self._lock:
+                    self.queries.append(record)
+                break
+
+    def record_summary(self, summary, query):
+        # called by SessionManager with the neo4j ResultSummary of every query
+        # it runs on this thread; only summaries of an open catalog query's
+        # own Cypher (possibly with a PROFILE / EXPLAIN prefix) are kept, not
+        # those of helper queries such as the QueryCache fingerprint
+        query = query.strip()
+        for record, text in reversed(self._open_queries):
+            if text is not None and query.endswith(text.strip()):
+                break
+        else:
+            return
+        record["available_after"] = summary.result_available_after
+        record["consumed_after"] = summary.result_consumed_after
+        if summary.profile:
+            record["db_hits"] = get_db_hits(summary.profile)
+
+    @contextmanager
+    def function(self, call_site):
+        frame = {"call_site": call_site, "query_time": 0.0}
+        self._frames.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            self._frames.pop()
+            with self._lock:
+                self.functions.append(
+                    {
+                        "call_site": call_site,
+                        "wall": wall,
+                        "query_time": frame["query_time"],
+                        "post_processing": wall - frame["query_time"],
+                    }
+                )
+
+    def get_query_summary(self):
+        summary = {}
+        for record in self.queries:
+            key = (record["call_site"], record["query"])
+            entry = summary.setdefault(
+                key,
+                {
+                    "call_site": record["call_site"],
+                    "query": record["query"],
+                    "calls": 0,
+                    "wall": 0.0,
+                    "rows": 0,
+                    "server_calls": 0,
+                    "available_after": 0,
+                    "consumed_after": 0,
+                    "db_hits": 0,
+                },
+            )
+            entry["calls"] += 1
+            entry["wall"] += record["wall"]
+            entry["rows"] += record["rows"]
+            if record["available_after"] is not None:
+                # queries answered by a QueryCache or a GraphSnapshot have no server timings
+                entry["server_calls"] += 1
+                entry["available_after"] += record["available_after"]
+                entry["consumed_after"] += record["consumed_after"]
+            entry["db_hits"] += record["db_hits"] or 0
+        return sorted(summary.values(), key=lambda entry: entry["wall"], reverse=True)
+
+    def get_function_summary(self):
+        summary = {}
+        for record in self.functions:
+            entry = summary.setdefault(
+                record["call_site"],
+                {"call_site": record["call_site"], "calls": 0, "wall": 0.0, "query_time": 0.0, "post_processing": 0.0},
+            )
+            entry["calls"] += 1
+            for field in ("wall", "query_time", "post_processing"):
+                entry[field] += record[field]
+        return sorted(summary.values(), key=lambda entry: entry["wall"], reverse=True)
+
+    def report(self, top_k=20):
+        print("------------------------- Query profile -------------------------")
+        for entry in self.get_query_summary()[:top_k]:
+            print(
+                f"{entry['wall']:8.2f}s {entry['calls']:6d}x {entry['rows']:9d} rows "
+                f"server {entry['available_after'] + entry['consumed_after']:8d}ms "
+                f"db hits {entry['db_hits']:10d}  {entry['query']} <- {entry['call_site']}"
+            )
+        print("------------------------- Function profile -------------------------")
+        for entry in self.get_function_summary()[:top_k]:
+            print(
+                f"{entry['wall']:8.2f}s {entry['calls']:6d}x queries {entry['query_time']:8.2f}s "
+                f"post-processing {entry['post_processing']:8.2f}s  {entry['call_site']}"
+            )
+
+    def to_json(self, path=PROFILE_FILE + ".json"):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "queries": self.get_query_summary(),
+                    "functions": self.get_function_summary(),
+                    "query_records": self.queries,
+                    "function_records": self.functions,
+                },
+                f,
+                indent=2,
+                default=str,
+            )
+
+    def to_csv(self, path=PROFILE_FILE):
+        # one file per summary: <path>_queries.csv and <path>_functions.csv
+        for name, rows in (
+            ("queries", self.get_query_summary()),
+            ("functions", self.get_function_summary()),
+        ):
+            if not rows:
+                continue
+            with open(f"{path}_{name}.csv", "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+def get_db_hits(profile):
+    # profile is the plan tree of a PROFILE summary
+    return profile.get("dbHits", 0) + sum(get_db_hits(child) for child in profile.get("children", []))
+
+
+def start_profiling(profile_queries=False):
+    # profile_queries runs every catalog query with PROFILE to get db hits
+    global active_profiler
+    active_profiler = Profiler(profile_queries)
+    return active_profiler
+
+
+def stop_profiling():
+    global active_profiler
+    profiler, active_profiler = active_profiler, None
+    return profiler
+
+
+def profiled(func):
+    # Marks an analysis function as a call site; queries it runs are
+    # attributed to it and its post-processing time is recorded.
+    call_site = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if active_profiler is None:
+            return func(*args, **kwargs)
+        with active_profiler.function(call_site):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def profile_rows(profiler, record, rows):
+    # wraps a streamed result, the query lasts until it is exhausted
+    elapsed = 0.0
+    try:
+        iterator = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                break
+            elapsed += time.perf_counter() - start
+            record["rows"] += 1
+            yield row
+    finally:
+        profiler.end_query(record, elapsed)
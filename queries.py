@@ -0,0 +1,259 @@
+import time
+from utils import request, request_with_summary, stream_request
+import profiler
+
+
+# Named Cypher queries. Values are passed as $parameters so the query text
+# (and the server plan cache entry) is shared by every disease; only labels,
+# relationship types and static fragments such as the wcc filter are filled
+# in with str.format, so literal braces are doubled.
+QUERIES = {
+    # graph_structure
+    "node_count": """
+    MATCH (n:{label}) {wcc_query} RETURN count(n) as count
+    """,
+    "rel_degree_stats": """
+    MATCH (a:{start})
+    Optional MATCH (a:{start})-[r:{rel}]->(b:{end})
+    {wcc_query}
+    With count(distinct r) as rel_count, a as a
+    RETURN min(rel_count) as min, max(rel_count) as max, avg(rel_count) as avg, stDev(rel_count) as stDev
+    """,
+    "rel_total_count": """
+    MATCH (a:{start})-[r:{rel}]->(b:{end})
+    RETURN count(distinct r) as count
+    """,
+    "rel_degree_stats_for_start": """
+    MATCH (a:{start})
+    Optional MATCH (a)-[r:{rels}]->(b)
+    WITH a, type(r) as rel, labels(b) as end_labels, count(distinct CASE WHEN {wcc_query} THEN r END) as rel_count, count(distinct r) as total
+    UNWIND $triples AS t
+    WITH t, a, sum(CASE WHEN rel = t.rel AND t.end IN end_labels THEN rel_count ELSE 0 END) as rel_count, sum(CASE WHEN rel = t.rel AND t.end IN end_labels THEN total ELSE 0 END) as total
+    RETURN t.rel as rel, t.end as end, min(rel_count) as min, max(rel_count) as max, avg(rel_count) as avg, stDev(rel_count) as stDev, sum(total) as count
+    """,
+    "rel_degree_histogram": """
+    MATCH (a:{start})
+    Optional MATCH (a:{start})-[r:{rel}]->(b:{end})
+    {wcc_query}
+    With count(distinct r) as rel_count, a as a
+    RETURN rel_count as degree, count(a) as nodes
+    """,
+    "rel_degree_histogram_for_start": """
+    MATCH (a:{start})
+    Optional MATCH (a)-[r:{rels}]->(b)
+    WITH a, type(r) as rel, labels(b) as end_labels, count(distinct CASE WHEN {wcc_query} THEN r END) as rel_count, count(distinct r) as total
+    UNWIND $triples AS t
+    WITH t, a, sum(CASE WHEN rel = t.rel AND t.end IN end_labels THEN rel_count ELSE 0 END) as rel_count, sum(CASE WHEN rel = t.rel AND t.end IN end_labels THEN total ELSE 0 END) as total
+    RETURN t.rel as rel, t.end as end, rel_count as degree, count(a) as nodes, sum(total) as count
+    """,
+    "rel_degree_sample_stats": """
+    MATCH (a:{start})
+    WHERE rand() < $probability
+    Optional MATCH (a)-[r:{rel}]->(b:{end})
+    {wcc_query}
+    With count(distinct r) as rel_count, a as a
+    RETURN count(a) as sample_size, min(rel_count) as min, max(rel_count) as max, avg(rel_count) as avg, stDev(rel_count) as stDev
+    """,
+    "hll_registers": """
+    MATCH (a:{start})-[r:{rel}]->(b:{end})
+    WITH {key} as key
+    WHERE key IS NOT NULL
+    WITH (((key % $prime) + $prime) % $prime * $a + $b) % $prime as h
+    WITH h, h * h % $prime as h2
+    WITH h, h2 * h2 % $prime as h4
+    WITH (h4 * h % $prime * $c + $d) % $prime as h
+    WITH h % $registers as register, h / $registers as w
+    RETURN register, max($rank_bits + 1 - CASE WHEN w = 0 THEN 0 ELSE toInteger(floor(log(w) / log(2) + 1e-9)) + 1 END) as rank
+    """,
+    "attribute_min_max_avg": """
+    MATCH (a:{start})-[r:{rel}]->(b:{end})
+    RETURN min(r.{attribute}) as min, max(r.{attribute}) as max, avg(r.{attribute}) as avg
+    """,
+    "attribute_profile": """
+    MATCH (a:{start})-[r:{rel}]->(b:{end})
+    RETURN count(r) as total, {aggregates}
+    """,
+    "attribute_histogram": """
+    MATCH (a:{start})-[r:{rel}]->(b:{end})
+    WITH r.{attribute} as value
+    WHERE value IS NOT NULL
+    RETURN toInteger(floor((value - $min) / $width)) as bin, count(*) as count
+    """,
+    "label_fingerprint": """
+    MATCH (n:{label}) RETURN count(n) as count, max(id(n)) as max_id
+    """,
+    "rel_type_fingerprint": """
+    MATCH ()-[r:{rel}]->() RETURN count(r) as count, max(id(r)) as max_id
+    """,
+    "disease_counts": """
+    MATCH (s:Biological_sample)-[r:HAS_DISEASE]->(b:Disease)
+    WITH count(r) as disease_count, b.name as name
+    WHERE disease_count >= $min_occurrence AND name <> 'control'
+    RETURN name, disease_count order by disease_count desc {limit}
+    """,
+    "disease_count_by_name": """
+    MATCH (s:Biological_sample)-[r:HAS_DISEASE]->(b:Disease {{name: $name}})
+    WITH count(r) as disease_count, b.name as name
+    WHERE disease_count >= $min_occurrence
+    RETURN name, disease_count
+    """,
+    "sick_people": """
+    Match(b:Disease) <-[r:HAS_DISEASE]-(a:Biological_sample)
+    where b.name <> 'control'
+    return count(distinct a) as sick_people
+    """,
+    "healthy_people": """
+    Match(b:Disease) <-[r:HAS_DISEASE]-(a:Biological_sample)
+    where b.name = 'control'
+    return count(distinct a) as healthy_people
+    """,
+    "undiagnosed_people": """
+    Match(a:Biological_sample)
+    where not (a)-[:HAS_DISEASE]->()
+    return count(a) as undiagnosed
+    """,
+    "all_relationships": """
+    MATCH (a)-[r]->(b) {wcc_query} RETURN distinct type(r) as relationship, labels(a)[0] as a,  labels(b)[0] as b
+    """,
+    "all_node_types": """
+    MATCH (a) {wcc_query} RETURN distinct labels(a) as labels
+    """,
+    "missing_ensamble_id": """
+    MATCH (b:Biological_sample)-[r:HAS_DAMAGE]->(g:Gene)
+    WHERE g.synonyms[1]=""
+    RETURN
+        count(DISTINCT b) AS number_of_biological_samples,
+        count(DISTINCT g) AS number_of_genes,
+        count(r) AS number_of_relationships
+    """,
+    "disease_synonyms": """
+    MATCH (d:Disease)
+    WHERE d.synonyms IS NOT NULL AND size(d.synonyms) > 0
+    UNWIND d.synonyms AS synonym
+    RETURN d.name AS name, synonym
+    """,
+    "icd10_disease_counts": """
+    MATCH (s:Biological_sample)-[r:HAS_DISEASE]->(d:Disease)
+    WITH d.name AS name, count(r) AS disease_count, collect(DISTINCT d.synonyms) AS synonyms
+    WHERE disease_count >= $min_occurrence AND name <> 'control'
+    WITH name, disease_count,
+        [synonym IN reduce(acc = [], node_synonyms IN synonyms | acc + coalesce(node_synonyms, [])) WHERE synonym STARTS WITH 'ICD10'] AS codes
+    WITH coalesce(last(codes), name) AS disease_group, last(codes) IS NOT NULL AS is_icd10, disease_count
+    RETURN disease_group, is_icd10, max(disease_count) AS disease_count
+    ORDER BY disease_count DESC
+    """,
+    # disease_analysis
+    "total_association_count_for_disease": """
+    MATCH (d:Disease {{name: $name}})<-[:HAS_DISEASE]-(s:Biological_sample)-[:{relationship_type}]->(n:{node_type})
+    RETURN d.name AS Disease, count(DISTINCT n) AS total_associations
+    ORDER BY total_associations DESC
+    """,
+    "type_occurrence_for_disease": """
+    MATCH (d:Disease {{name: $name}})<-[:HAS_DISEASE]-(s:Biological_sample)-[r:{relationship_type}]->(n:{node_type})
+    WITH count(DISTINCT r) AS samples_with_node, n AS n
+    RETURN n.name AS node_name, samples_with_node
+    """,
+    "diseases_with_max_occurrences": """
+    Match (d:Disease)<-[:HAS_DISEASE]-(s:Biological_sample)
+    with d, count(s) as count
+    where count <= $occurrences
+    return d.name as name, count order by count desc
+    """,
+    "number_of_occurrences": """
+    Match (d:Disease {{name: $name}})<-[:HAS_DISEASE]-(s:Biological_sample)
+    return count(s) as count
+    """,
+    # graph_snapshot
+    "snapshot_nodes": """
+    MATCH (n:{label}) RETURN id(n) as id, n.name as name
+    """,
+    "snapshot_edges": """
+    MATCH (s:Biological_sample)-[r:{rel}]->(n:{label}) RETURN id(s) as sample, id(n) as node
+    """,
+    # feature_matrix
+    "all_disease_counts": """
+    MATCH (s:Biological_sample)-[r:HAS_DISEASE]->(d:Disease)
+    WHERE d.name IS NOT NULL AND ($diseases IS NULL OR d.name IN $diseases)
+    RETURN d.name AS name, count(r) AS disease_count
+    ORDER BY disease_count DESC
+    """,
+    "feature_occurrences": """
+    MATCH (d:Disease)<-[:HAS_DISEASE]-(s:Biological_sample)-[r:{rels}]->(n)
+    WHERE ($diseases IS NULL OR d.name IN $diseases)
+        AND any(c IN $connections WHERE c[0] = type(r) AND c[1] IN labels(n))
+    WITH d.name AS disease, type(r) AS relationship, n, count(DISTINCT r) AS samples_with_node
+    RETURN disease, relationship, n.name AS node_name, samples_with_node
+    """,
+}
+
+# EXPLAIN plans / PROFILE results captured by run_query, keyed by query name
+plans = {}
+
+
+def get_query(name, **template_args):
+    return QUERIES[name].format(**template_args)
+
+
+def get_query_text(driver, name, template_args):
+    # the Cypher a catalog query sends, None for backends without Cypher
+    if hasattr(driver, "run_catalog"):
+        return None
+    return get_query(name, **template_args)
+
+
+def run_query(driver, name, parameters=None, capture_plan=None, **template_args):
+    # capture_plan is None, "EXPLAIN" (plan only, the query then runs as
+    # usual) or "PROFILE" (the query runs once with profiling). Backends
+    # without Cypher (graph_snapshot.GraphSnapshot) answer by query name.
+    # While profiler.start_profiling is active every call is recorded.
+    active_profiler = profiler.active_profiler
+    if active_profiler is None:
+        return _run_query(driver, name, parameters, capture_plan, template_args)
+    if active_profiler.profile_queries and capture_plan is None:
+        capture_plan = "PROFILE"
+    record = active_profiler.start_query(name, get_query_text(driver, name, template_args))
+    start = time.perf_counter()
+    try:
+        result = _run_query(driver, name, parameters, capture_plan, template_args)
+        record["rows"] = len(result)
+    finally:
+        active_profiler.end_query(record, time.perf_counter() - start)
+    return result
+
+
+def _run_query(driver, name, parameters, capture_plan, template_args):
+    if hasattr(driver, "run_catalog"):
+        return driver.run_catalog(name, parameters or {}, template_args)
+    query = get_query(name, **template_args)
+    if capture_plan == "PROFILE":
+        result, summary = request_with_summary(driver, "PROFILE " + query, parameters)
+        plans[name] = summary.profile
+        return result
+    if capture_plan == "EXPLAIN":
+        explain_query(driver, name, parameters, **template_args)
+    return request(driver, query, parameters)
+
+
+def stream_query(driver, name, parameters=None, fetch_size=None, **template_args):
+    rows = _stream_query(driver, name, parameters, fetch_size, template_args)
+    active_profiler = profiler.active_profiler
+    if active_profiler is None:
+        return rows
+    record = active_profiler.start_query(name, get_query_text(driver, name, template_args))
+    return profiler.profile_rows(active_profiler, record, rows)
+
+
+def _stream_query(driver, name, parameters, fetch_size, template_args):
+    if hasattr(driver, "run_catalog"):
+        yield from driver.run_catalog(name, parameters or {}, template_args)
+        return
+    query = get_query(name, **template_args)
+    yield from stream_request(driver, query, parameters, fetch_size)
+
+
+def explain_query(driver, name, parameters=None, profile=False, **template_args):
+    prefix = "PROFILE " if profile else "EXPLAIN "
+    query = get_query(name, **template_args)
+    _, summary = request_with_summary(driver, prefix + query, parameters)
+    plans[name] = summary.profile if profile else summary.plan
+    return plans[name]
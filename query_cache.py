@@ -0,0 +1,181 @@
+import hashlib
+import json
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from utils import request, request_with_summary, stream_request
+
+
+CACHE_FILE = "./query_cache.sqlite"
+MAX_CACHE_BYTES = 1024 * 1024 * 1024
+MAX_STREAM_ROWS = 1000000
+# queries calling these (e.g. the sampled rel_degree_sample_stats) give a new
+# result on every run and are never cached
+NONDETERMINISTIC_FUNCTIONS = re.compile(r"\b(rand|randomUUID|timestamp)\s*\(", re.IGNORECASE)
+
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+
+def get_cache_key(query, parameters=None):
+    key = normalize_query(query) + "\n" + json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(query):
+    return NONDETERMINISTIC_FUNCTIONS.search(query) is None
+
+
+def get_graph_fingerprint(driver):
+    # Node counts per label and relationship counts per type are answered
+    # from the count store, so this stays cheap on the full graph.
+    counts = {}
+    for row in request(driver, "CALL db.labels() YIELD label RETURN label"):
+        label = row["label"]
+        result = request(driver, f"MATCH (n:`{label}`) RETURN count(n) as count")
+        counts[f"(:{label})"] = result[0]["count"]
+    for row in request(
+        driver, "CALL db.relationshipTypes() YIELD relationshipType RETURN relationshipType"
+    ):
+        rel = row["relationshipType"]
+        result = request(driver, f"MATCH ()-[r:`{rel}`]->() RETURN count(r) as count")
+        counts[f"[:{rel}]"] = result[0]["count"]
+    fingerprint = json.dumps(counts, sort_keys=True)
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+class QueryCache:
+    # Wraps a driver (or SessionManager) and answers repeated queries from a
+    # SQLite file. Entries are dropped when the graph fingerprint changes and
+    # the least recently used ones are evicted above max_bytes. Queries using
+    # rand() and the like are passed through uncached.
+    def __init__(
+        self,
+        driver,
+        path=CACHE_FILE,
+        max_bytes=MAX_CACHE_BYTES,
+        max_stream_rows=MAX_STREAM_ROWS,
+    ):
+        self.driver = driver
+        self.max_bytes = max_bytes
+        self.max_stream_rows = max_stream_rows
+        self.hits = 0
+        self.misses = 0
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                query TEXT,
+                data BLOB,
+                size INTEGER,
+                last_access REAL
+            )"""
+        )
+        self.connection.commit()
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = get_graph_fingerprint(self.driver)
+            with self._lock:
+                self.connection.execute(
+                    "DELETE FROM results WHERE fingerprint <> ?", (self._fingerprint,)
+                )
+                self.connection.commit()
+        return self._fingerprint
+
+    def get(self, query, parameters=None):
+        key = get_cache_key(query, parameters)
+        fingerprint = self.fingerprint
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT data FROM results WHERE key = ? AND fingerprint = ?",
+                (key, fingerprint),
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+        return pickle.loads(row[0])
+
+    def put(self, query, parameters, result):
+        key = get_cache_key(query, parameters)
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        fingerprint = self.fingerprint
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (key, fingerprint, normalize_query(query), data, len(data), time.time()),
+            )
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        total = self.connection.execute("SELECT coalesce(sum(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM results ORDER BY last_access ASC"
+        ).fetchall():
+            self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def run(self, query, parameters=None):
+        if not is_cacheable(query):
+            return request(self.driver, query, parameters)
+        result = self.get(query, parameters)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = request(self.driver, query, parameters)
+        self.put(query, parameters, result)
+        return result
+
+    def stream(self, query, parameters=None, fetch_size=None):
+        # Cache hits are replayed from the stored rows; misses are streamed
+        # through and stored once the consumer has read them all, unless
+        # there are more than max_stream_rows of them.
+        if not is_cacheable(query):
+            yield from stream_request(self.driver, query, parameters, fetch_size)
+            return
+        result = self.get(query, parameters)
+        if result is not None:
+            self.hits += 1
+            yield from result
+            return
+        self.misses += 1
+        rows = []
+        for row in stream_request(self.driver, query, parameters, fetch_size):
+            if rows is not None:
+                rows.append(row)
+                if len(rows) > self.max_stream_rows:
+                    rows = None
+            yield row
+        if rows is not None:
+            self.put(query, parameters, rows)
+
+    def run_with_summary(self, query, parameters=None):
+        return request_with_summary(self.driver, query, parameters)
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM results")
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+        if hasattr(self.driver, "close"):
+            self.driver.close()
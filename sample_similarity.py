@@ -0,0 +1,335 @@
+import hashlib
+import json
+import os
+import numpy as np
+from scipy import sparse
+from utils import feature_connections
+from graph_snapshot import GraphSnapshot, SAMPLE_LABEL
+
+
+SIMILARITY_FOLDER = "./sample_similarity"
+MINHASH_PRIME = (1 << 31) - 1
+# empty samples get this signature and are left out of the LSH buckets
+EMPTY_HASH = np.uint32(MINHASH_PRIME)
+# hash values computed at once when building signatures
+HASH_CHUNK = 1 << 24
+
+
+def get_feature_columns(snapshot, connections):
+    # One column per (node type, name): nodes sharing a name collapse and
+    # nodes without a name (column -1) are left out, like in the common
+    # groups. Returns the column of every node per relationship and the
+    # (node type, name) of every column.
+    columns = {}
+    features = []
+    for relationship_type, node_type in connections:
+        snapshot.check_relationship(relationship_type, node_type)
+        node_names = snapshot.names[node_type]
+        names = sorted({name for name in node_names if name is not None})
+        index = {name: j + len(features) for j, name in enumerate(names)}
+        columns[relationship_type] = np.array([index.get(name, -1) for name in node_names], dtype=np.int64)
+        features += [(node_type, name) for name in names]
+    return columns, features
+
+
+def get_incidence(snapshot, connections, columns, feature_count):
+    # binary samples x features matrix over all connections
+    matrices = []
+    for relationship_type, _ in connections:
+        edge_columns = columns[relationship_type][snapshot.indices[relationship_type]]
+        named = edge_columns >= 0
+        matrices.append(
+            sparse.csr_matrix(
+                (
+                    np.ones(int(named.sum()), dtype=np.float32),
+                    (snapshot.get_edge_samples(relationship_type)[named], edge_columns[named]),
+                ),
+                shape=(snapshot.sample_count, feature_count),
+            )
+        )
+    # the columns are already offset per relationship, so the blocks just add up
+    incidence = sum(matrices[1:], matrices[0]).tocsr()
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    return incidence
+
+
+def get_snapshot_fingerprint(snapshot, connections):
+    # hash of the samples, node names and edges the index is built from
+    digest = hashlib.sha256(str(snapshot.sample_count).encode("utf-8"))
+    for relationship_type, node_type in connections:
+        digest.update(json.dumps(snapshot.names[node_type]).encode("utf-8"))
+        digest.update(np.ascontiguousarray(snapshot.indptr[relationship_type]).tobytes())
+        digest.update(np.ascontiguousarray(snapshot.indices[relationship_type]).tobytes())
+    return digest.hexdigest()
+
+
+def get_idf(incidence):
+    # smoothed idf as in sklearn's TfidfTransformer
+    document_frequency = np.bincount(incidence.indices, minlength=incidence.shape[1])
+    return (np.log((1 + incidence.shape[0]) / (1 + document_frequency)) + 1).astype(np.float32)
+
+
+def normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    return sparse.diags(1 / np.maximum(norms, 1e-12)).dot(matrix).tocsr().astype(np.float32)
+
+
+def get_minhash_parameters(num_perm, seed):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MINHASH_PRIME, num_perm, dtype=np.int64)
+    b = rng.integers(0, MINHASH_PRIME, num_perm, dtype=np.int64)
+    return a, b
+
+
+def get_minhash_signatures(matrix, a, b):
+    # signatures[i, p] = min over the columns x of row i of (a[p] x + b[p]) mod prime
+    signatures = np.full((matrix.shape[0], len(a)), EMPTY_HASH, dtype=np.uint32)
+    rows = np.flatnonzero(np.diff(matrix.indptr))
+    if not len(rows):
+        return signatures
+    indices = matrix.indices.astype(np.int64)
+    starts = matrix.indptr[rows]
+    step = max(1, HASH_CHUNK // max(len(indices), 1))
+    for start in range(0, len(a), step):
+        end = min(start + step, len(a))
+        hashes = (a[start:end, None] * indices[None, :] + b[start:end, None]) % MINHASH_PRIME
+        signatures[rows, start:end] = np.minimum.reduceat(hashes, starts, axis=1).T
+    return signatures
+
+
+def get_band_keys(signatures, bands):
+    # one 64-bit key per sample and band (FNV-style mix of the band's rows)
+    rows = signatures.shape[1] // bands
+    keys = np.full((bands, signatures.shape[0]), 14695981039346656037, dtype=np.uint64)
+    for band in range(bands):
+        for value in signatures[:, band * rows : (band + 1) * rows].T:
+            keys[band] = (keys[band] ^ value.astype(np.uint64)) * np.uint64(1099511628211)
+    return keys
+
+
+class SimilarityIndex:
+    # Sample similarity search over the HAS_PHENOTYPE / HAS_DAMAGE /
+    # HAS_PROTEIN profiles of a GraphSnapshot: L2-normalized TF-IDF rows per
+    # Biological_sample, MinHash signatures of their feature sets and an LSH
+    # banding index on those. Similar samples are LSH candidates ranked by
+    # TF-IDF cosine; profiles (a cohort or get_common_groups output) are
+    # compared to all samples or disease profiles with one sparse product.
+    # With the default of one row per band, every sample sharing one MinHash
+    # value is a candidate: on the 10k sample synthetic graph, rows of 2
+    # found 0.37 of the exact top 10, one row 0.99. A stored index is only loaded if it was
+    # built with the same settings from the same snapshot arrays.
+    def __init__(
+        self,
+        snapshot,
+        path=None,
+        connections=feature_connections,
+        num_perm=128,
+        bands=128,
+        max_share=0.05,
+        seed=0,
+    ):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.snapshot = snapshot
+        self.path = path
+        self.connections = [tuple(c) for c in connections]
+        self.num_perm = num_perm
+        self.bands = bands
+        self.max_share = max_share
+        self.seed = seed
+        self.fingerprint = get_snapshot_fingerprint(snapshot, self.connections)
+        if path is not None and self.is_stored():
+            self.load()
+        else:
+            self._build()
+            if path is not None:
+                os.makedirs(path, exist_ok=True)
+                self.save()
+        self.feature_index = {feature: j for j, feature in enumerate(self.features)}
+        self.sample_names = snapshot.names[SAMPLE_LABEL]
+        self._sample_index = None
+
+    def _build(self):
+        columns, self.features = get_feature_columns(self.snapshot, self.connections)
+        incidence = get_incidence(self.snapshot, self.connections, columns, len(self.features))
+        self.idf = get_idf(incidence)
+        self.tfidf = normalize_rows(incidence.multiply(self.idf[None, :]).tocsr())
+        self.a, self.b = get_minhash_parameters(self.num_perm, self.seed)
+        # features in more than max_share of the samples would make most
+        # pairs collide in some band, they are left out of the MinHash sets
+        common = np.bincount(incidence.indices, minlength=incidence.shape[1]) > self.max_share * incidence.shape[0]
+        incidence = incidence.multiply(~common[None, :]).tocsr()
+        incidence.eliminate_zeros()
+        self.signatures = get_minhash_signatures(incidence, self.a, self.b)
+        self._build_buckets()
+        self.disease_names = []
+        self.disease_profiles = None
+
+    def _build_buckets(self):
+        # per band the keys of all non-empty samples, sorted, and their samples
+        samples = np.flatnonzero(self.signatures[:, 0] != EMPTY_HASH)
+        keys = get_band_keys(self.signatures[samples], self.bands)
+        order = np.argsort(keys, axis=1, kind="stable")
+        self.band_keys = np.take_along_axis(keys, order, axis=1)
+        self.band_samples = samples[order].astype(np.int32)
+
+    def get_settings(self):
+        return {
+            "connections": [list(c) for c in self.connections],
+            "num_perm": self.num_perm,
+            "bands": self.bands,
+            "max_share": self.max_share,
+            "seed": self.seed,
+            "fingerprint": self.fingerprint,
+        }
+
+    def is_stored(self):
+        if not os.path.exists(f"{self.path}/similarity.json"):
+            return False
+        with open(f"{self.path}/similarity.json", "r") as f:
+            meta = json.load(f)
+        return all(meta.get(key) == value for key, value in self.get_settings().items())
+
+    def save(self):
+        np.savez(
+            f"{self.path}/similarity.npz",
+            tfidf_data=self.tfidf.data,
+            tfidf_indices=self.tfidf.indices,
+            tfidf_indptr=self.tfidf.indptr,
+            idf=self.idf,
+            a=self.a,
+            b=self.b,
+            signatures=self.signatures,
+            band_keys=self.band_keys,
+            band_samples=self.band_samples,
+        )
+        if self.disease_profiles is not None:
+            sparse.save_npz(f"{self.path}/disease_profiles.npz", self.disease_profiles)
+        with open(f"{self.path}/similarity.json", "w") as f:
+            json.dump(
+                {**self.get_settings(), "features": self.features, "diseases": self.disease_names},
+                f,
+            )
+
+    def load(self):
+        with open(f"{self.path}/similarity.json", "r") as f:
+            meta = json.load(f)
+        self.features = [tuple(feature) for feature in meta["features"]]
+        self.disease_names = meta["diseases"]
+        arrays = np.load(f"{self.path}/similarity.npz")
+        self.tfidf = sparse.csr_matrix(
+            (arrays["tfidf_data"], arrays["tfidf_indices"], arrays["tfidf_indptr"]),
+            shape=(self.snapshot.sample_count, len(self.features)),
+        )
+        self.idf = arrays["idf"]
+        self.a = arrays["a"]
+        self.b = arrays["b"]
+        self.signatures = arrays["signatures"]
+        self.band_keys = arrays["band_keys"]
+        self.band_samples = arrays["band_samples"]
+        self.disease_profiles = None
+        if self.disease_names:
+            self.disease_profiles = sparse.load_npz(f"{self.path}/disease_profiles.npz").tocsr()
+
+    # -- profiles
+
+    def get_sample(self, sample):
+        # sample index from a Biological_sample name or index
+        if isinstance(sample, str):
+            if self._sample_index is None:
+                self._sample_index = {name: i for i, name in enumerate(self.sample_names)}
+            return self._sample_index[sample]
+        return int(sample)
+
+    def get_cohort_profile(self, samples):
+        # share of the samples with every feature, TF-IDF weighted and normalized
+        incidence = self.tfidf[np.asarray(samples, dtype=np.int64)] > 0
+        shares = np.asarray(incidence.sum(axis=0)).ravel() / max(len(samples), 1)
+        return normalize_rows(sparse.csr_matrix(shares * self.idf))
+
+    def get_common_groups_profile(self, common_groups, disease_count):
+        # common_groups as returned by disease_analysis.get_common_groups;
+        # features missing from the index are ignored
+        shares = np.zeros(len(self.features))
+        for group in common_groups:
+            for node_type, common_group in group.items():
+                for name, count in common_group.items():
+                    j = self.feature_index.get((node_type, name))
+                    if j is not None:
+                        shares[j] = min(count / max(disease_count, 1), 1.0)
+        return normalize_rows(sparse.csr_matrix(shares * self.idf))
+
+    def add_disease_profiles(self, cohort_index, disease_names=None):
+        # cohort profile of every disease of a CohortIndex on the same snapshot
+        if disease_names is None:
+            disease_names = cohort_index.disease_names
+        membership = cohort_index.get_membership(disease_names)
+        counts = membership.T @ (self.tfidf > 0).astype(np.float32)
+        sizes = np.asarray(membership.sum(axis=0)).ravel()
+        shares = sparse.diags(1 / np.maximum(sizes, 1)).dot(counts)
+        self.disease_names = list(disease_names)
+        self.disease_profiles = normalize_rows(sparse.csr_matrix(shares).multiply(self.idf[None, :]).tocsr())
+        if self.path is not None:
+            self.save()
+
+    def get_disease_profile(self, disease_name):
+        i = self.disease_names.index(disease_name)
+        return self.disease_profiles[i]
+
+    # -- queries
+
+    def get_candidates(self, sample):
+        # samples sharing at least one LSH band with the sample
+        keys = get_band_keys(self.signatures[[sample]], self.bands)[:, 0]
+        candidates = []
+        for band, key in enumerate(keys):
+            low = np.searchsorted(self.band_keys[band], key, side="left")
+            high = np.searchsorted(self.band_keys[band], key, side="right")
+            candidates.append(self.band_samples[band, low:high])
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[candidates != sample]
+
+    def rank(self, profile, candidates, k):
+        similarities = np.asarray((self.tfidf[candidates] @ profile.T).todense()).ravel()
+        top = np.argsort(-similarities, kind="stable")[:k]
+        return [(self.sample_names[candidates[i]], float(similarities[i])) for i in top]
+
+    def get_similar_samples(self, sample, k=10, exact=False):
+        # top k (sample name, cosine) of one sample; exact ranks all samples
+        # instead of the LSH candidates
+        sample = self.get_sample(sample)
+        if exact:
+            candidates = np.flatnonzero(np.arange(self.tfidf.shape[0]) != sample)
+        else:
+            candidates = self.get_candidates(sample)
+        return self.rank(self.tfidf[sample], candidates, k)
+
+    def get_samples_like_profile(self, profile, k=10):
+        # top k samples of a cohort or common groups profile, over all samples:
+        # one sparse matrix-vector product
+        return self.rank(profile, np.arange(self.tfidf.shape[0]), k)
+
+    def get_similar_diseases(self, profile, k=10):
+        # top k (disease name, cosine) of a profile or a disease name, needs
+        # add_disease_profiles
+        if self.disease_profiles is None:
+            raise ValueError("No disease profiles, call add_disease_profiles first")
+        exclude = None
+        if isinstance(profile, str):
+            exclude = self.disease_names.index(profile)
+            profile = self.disease_profiles[exclude]
+        similarities = np.asarray((self.disease_profiles @ profile.T).todense()).ravel()
+        if exclude is not None:
+            similarities[exclude] = -np.inf
+        top = np.argsort(-similarities, kind="stable")[:k]
+        return [(self.disease_names[i], float(similarities[i])) for i in top if np.isfinite(similarities[i])]
+
+
+def build_similarity_index(snapshot_path, path=SIMILARITY_FOLDER, cohort_index=None, **kwargs):
+    # Builds the index (with disease profiles when a CohortIndex is given)
+    # unless an up to date one is stored; later runs only load it.
+    index = SimilarityIndex(GraphSnapshot(snapshot_path), path, **kwargs)
+    if index.disease_profiles is None and cohort_index is not None:
+        index.add_disease_profiles(cohort_index)
+    return index
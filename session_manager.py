@@ -0,0 +1,161 @@
+import threading
+import time
+from contextlib import contextmanager
+from neo4j import GraphDatabase
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+import utils
+import profiler
+
+
+RETRYABLE_ERRORS = (ServiceUnavailable, SessionExpired, TransientError)
+
+
+class SessionManager:
+    # Drop-in replacement for the neo4j driver in utils.request: keeps one
+    # session (and optionally one read transaction) open for a whole run
+    # instead of opening a new session for every query. Sessions are not
+    # thread safe, so every thread gets its own; pool_size bounds how many
+    # of them can have a query in flight.
+    def __init__(
+        self,
+        url=utils.NEO4J_URL,
+        login=utils.NEO4J_LOGIN,
+        password=utils.NEO4J_PASSWORD,
+        database=utils.NEO4J_DATABASE,
+        pool_size=10,
+        fetch_size=1000,
+        max_retries=1,
+    ):
+        self.driver = GraphDatabase.driver(
+            url, auth=(login, password), max_connection_pool_size=pool_size
+        )
+        self.database = database
+        self.fetch_size = fetch_size
+        self.max_retries = max_retries
+        self.timings = []
+        self._local = threading.local()
+        self._sessions = set()
+        self._lock = threading.Lock()
+
+    @property
+    def _session(self):
+        return getattr(self._local, "session", None)
+
+    @_session.setter
+    def _session(self, session):
+        self._local.session = session
+
+    @property
+    def _transaction(self):
+        return getattr(self._local, "transaction", None)
+
+    @_transaction.setter
+    def _transaction(self, transaction):
+        self._local.transaction = transaction
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = self.driver.session(
+                database=self.database, fetch_size=self.fetch_size
+            )
+            with self._lock:
+                self._sessions.add(self._session)
+        return self._session
+
+    def _reset_session(self):
+        if self._transaction is not None:
+            try:
+                self._transaction.close()
+            except Exception:
+                pass
+            self._transaction = None
+        if self._session is not None:
+            with self._lock:
+                self._sessions.discard(self._session)
+            try:
+                self._session.close()
+            except Exception:
+                pass
+            self._session = None
+
+    def _run(self, query, parameters):
+        if self._transaction is not None:
+            return self._transaction.run(query, parameters)
+        return self._get_session().run(query, parameters)
+
+    def run(self, query, parameters=None):
+        return self.run_with_summary(query, parameters)[0]
+
+    def run_with_summary(self, query, parameters=None):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                result = self._run(query, parameters)
+                data = result.data()
+                summary = result.consume()
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                print(f"Query failed ({e.__class__.__name__}), retrying with a new session")
+                # an open transaction is lost with its session, the retry runs
+                # as an auto-commit query
+                self._reset_session()
+        self.timings.append((query, time.perf_counter() - start))
+        if profiler.active_profiler is not None:
+            profiler.active_profiler.record_summary(summary, query)
+        return data, summary
+
+    def stream(self, query, parameters=None, fetch_size=None):
+        # A streamed result keeps its session busy until it is exhausted, so
+        # it gets a session of its own from the pool.
+        start = time.perf_counter()
+        with self.driver.session(
+            database=self.database, fetch_size=fetch_size or self.fetch_size
+        ) as session:
+            result = session.run(query, parameters)
+            for record in result:
+                yield record.data()
+            summary = result.consume()
+        self.timings.append((query, time.perf_counter() - start))
+        if profiler.active_profiler is not None:
+            profiler.active_profiler.record_summary(summary, query)
+
+    @contextmanager
+    def transaction(self):
+        # Runs every query inside the block in a single read transaction.
+        if self._transaction is not None:
+            yield self
+            return
+        self._transaction = self._get_session().begin_transaction()
+        try:
+            yield self
+        finally:
+            if self._transaction is not None:
+                self._transaction.close()
+                self._transaction = None
+
+    def total_time(self):
+        return sum(elapsed for _, elapsed in self.timings)
+
+    def slowest_queries(self, top_k=10):
+        return sorted(self.timings, key=lambda item: item[1], reverse=True)[:top_k]
+
+    def close(self):
+        self._reset_session()
+        with self._lock:
+            sessions, self._sessions = self._sessions, set()
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+        self.driver.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
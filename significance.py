@@ -0,0 +1,228 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from scipy.special import gammaln
+from scipy.stats import chi2
+
+
+# One entry per tested (disease, feature) pair: features seen in the disease
+# or in the control, as in comparison.compare_to_control. rows index into
+# diseases, cols into the features of the FeatureMatrix.
+SignificanceResult = namedtuple(
+    "SignificanceResult",
+    ["diseases", "features", "rows", "cols", "p_values", "q_values", "odds_ratios", "exact"],
+)
+
+# elements of the padded Fisher support evaluated at once
+FISHER_CHUNK = 4000000
+
+
+def get_log_factorials(n):
+    # log(i!) for i = 0..n
+    return gammaln(np.arange(n + 1, dtype=np.float64) + 1)
+
+
+def log_choose(log_factorials, n, k):
+    return log_factorials[n] - log_factorials[k] - log_factorials[n - k]
+
+
+def fisher_exact_p_values(a, feature_totals, disease_totals, control_total):
+    # Two-sided Fisher exact test of [[a, n1 - a], [K - a, n0 - K + a]] for
+    # arrays a, K (feature_totals) and n1 (disease_totals): sums the
+    # hypergeometric pmf over the whole support, like scipy.stats.fisher_exact.
+    # Every distinct (a, K, n1) is only computed once.
+    a = np.asarray(a, dtype=np.int64)
+    feature_totals = np.asarray(feature_totals, dtype=np.int64)
+    disease_totals = np.asarray(disease_totals, dtype=np.int64)
+    k_base = int(feature_totals.max()) + 1
+    a_base = int(a.max()) + 1
+    keys = (disease_totals * k_base + feature_totals) * a_base + a
+    unique, inverse = np.unique(keys, return_inverse=True)
+    a = unique % a_base
+    k = unique // a_base % k_base
+    n1 = unique // a_base // k_base
+    total = n1 + control_total
+    log_factorials = get_log_factorials(int(total.max()))
+    low = np.maximum(0, k - control_total)
+    high = np.minimum(n1, k)
+    lengths = high - low + 1
+    p_values = np.empty(len(unique))
+
+    order = np.argsort(lengths, kind="stable")
+    start = 0
+    while start < len(order):
+        # similar support lengths share one padded block
+        width = lengths[order[start]]
+        end = start + 1
+        while end < len(order) and lengths[order[end]] * (end + 1 - start) <= FISHER_CHUNK:
+            width = lengths[order[end]]
+            end += 1
+        block = order[start:end]
+        x = low[block, None] + np.arange(width)[None, :]
+        valid = x <= high[block, None]
+        x = np.minimum(x, high[block, None])
+        base = log_choose(log_factorials, total[block], n1[block])
+        log_pmf = log_choose(log_factorials, k[block, None], x) + log_choose(
+            log_factorials, total[block, None] - k[block, None], n1[block, None] - x
+        ) - base[:, None]
+        observed = log_choose(log_factorials, k[block], a[block]) + log_choose(
+            log_factorials, total[block] - k[block], n1[block] - a[block]
+        ) - base
+        extreme = valid & (log_pmf <= observed[:, None] + np.log1p(1e-7))
+        p_values[block] = np.where(extreme, np.exp(log_pmf), 0).sum(axis=1)
+        start = end
+    return np.minimum(p_values, 1.0)[inverse.ravel()]
+
+
+def chi2_p_values(a, feature_totals, disease_totals, control_total):
+    # Pearson chi-square test with one degree of freedom, no continuity correction
+    a = a.astype(np.float64)
+    n1 = disease_totals.astype(np.float64)
+    k = feature_totals.astype(np.float64)
+    total = n1 + control_total
+    b = n1 - a
+    c = k - a
+    d = control_total - c
+    denominator = n1 * control_total * k * (total - k)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistic = total * (a * d - b * c) ** 2 / denominator
+    return np.where(denominator > 0, chi2.sf(statistic, 1), 1.0)
+
+
+def get_odds_ratios(a, feature_totals, disease_totals, control_total):
+    # Haldane-Anscombe correction: 0.5 added to every cell
+    b = disease_totals - a
+    c = feature_totals - a
+    d = control_total - c
+    return ((a + 0.5) * (d + 0.5)) / ((b + 0.5) * (c + 0.5))
+
+
+def benjamini_hochberg(p_values, groups=None):
+    # q-values, within every group separately when groups is given
+    p_values = np.asarray(p_values, dtype=np.float64)
+    if groups is None:
+        groups = np.zeros(len(p_values), dtype=np.int64)
+    order = np.lexsort((p_values, groups))
+    sorted_groups = groups[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_groups)) + 1]
+    sizes = np.diff(np.r_[starts, len(order)])
+    group_start = np.repeat(starts, sizes)
+    group_size = np.repeat(sizes, sizes)
+    ranks = np.arange(len(order)) - group_start + 1
+    q = p_values[order] * group_size / ranks
+    # running minimum from the largest p-value down, restarted per group
+    q = q[::-1]
+    reversed_groups = sorted_groups[::-1]
+    for_group = np.r_[0, np.flatnonzero(np.diff(reversed_groups)) + 1]
+    for start, end in zip(for_group, np.r_[for_group[1:], len(q)]):
+        q[start:end] = np.minimum.accumulate(q[start:end])
+    q_values = np.empty(len(p_values))
+    q_values[order] = np.minimum(q[::-1], 1.0)
+    return q_values
+
+
+def test_rows(counts, disease_totals, control_counts, control_total, method):
+    # counts: csr rows of the tested diseases, control_counts: dense row
+    counts = counts.toarray()
+    seen = (counts > 0) | (control_counts > 0)
+    rows, cols = np.nonzero(seen)
+    n1 = disease_totals[rows]
+    # parallel edges can count a sample twice
+    a = np.minimum(counts[rows, cols], n1)
+    c = np.minimum(control_counts[cols], control_total)
+    k = a + c
+    if method == "fisher":
+        exact = np.ones(len(a), dtype=bool)
+    elif method == "chi2":
+        exact = np.zeros(len(a), dtype=bool)
+    else:
+        # Fisher where the chi-square approximation is unreliable (smallest
+        # expected cell count below 5)
+        total = n1 + control_total
+        expected = np.minimum(n1, control_total) * np.minimum(k, total - k) / total
+        exact = expected < 5
+    p_values = np.empty(len(a))
+    if exact.any():
+        p_values[exact] = fisher_exact_p_values(a[exact], k[exact], n1[exact], control_total)
+    if (~exact).any():
+        p_values[~exact] = chi2_p_values(a[~exact], k[~exact], n1[~exact], control_total)
+    odds_ratios = get_odds_ratios(a, k, n1, control_total)
+    return [rows.astype(np.int32), cols.astype(np.int32), p_values, odds_ratios, exact]
+
+
+def test_against_control(
+    matrix,
+    control_name="control",
+    disease_names=None,
+    method="auto",
+    fdr="disease",
+    chunk_size=256,
+    processes=1,
+):
+    # Tests every feature of every disease in disease_names (default: all
+    # but the control) for a different share of samples than in the control.
+    # method is "fisher", "chi2" or "auto"; fdr is "disease" (one
+    # Benjamini-Hochberg family per disease) or "all".
+    if disease_names is None:
+        disease_names = [name for name in matrix.diseases if name != control_name]
+    disease_index = {name: i for i, name in enumerate(matrix.diseases)}
+    rows = np.array([disease_index[name] for name in disease_names], dtype=np.int64)
+    counts = sparse.csr_matrix(matrix.counts)
+    disease_totals = np.asarray(matrix.disease_counts, dtype=np.int64)
+    control_row = disease_index[control_name]
+    control_counts = counts.getrow(control_row).toarray().ravel()
+    control_total = int(disease_totals[control_row])
+
+    chunks = [rows[start : start + chunk_size] for start in range(0, len(rows), chunk_size)]
+    arguments = [
+        (counts[chunk], disease_totals[chunk], control_counts, control_total, method)
+        for chunk in chunks
+    ]
+    if processes == 1:
+        results = [test_rows(*args) for args in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(test_rows, *zip(*arguments)))
+
+    offsets = np.cumsum([0] + [len(chunk) for chunk in chunks])
+    fields = []
+    for i in range(5):
+        # rows are per chunk, everything else is concatenated as is
+        parts = [r[i] + offset if i == 0 else r[i] for r, offset in zip(results, offsets)]
+        fields.append(np.concatenate(parts) if parts else np.zeros(0))
+        for r in results:
+            r[i] = None
+    result_rows, cols, p_values, odds_ratios, exact = fields
+    return SignificanceResult(
+        diseases=list(disease_names),
+        features=matrix.features,
+        rows=result_rows,
+        cols=cols,
+        p_values=p_values,
+        q_values=benjamini_hochberg(p_values, result_rows if fdr == "disease" else None),
+        odds_ratios=odds_ratios,
+        exact=exact,
+    )
+
+
+def get_significant_features(result, disease_name, alpha=0.05):
+    # {feature: (p, q, odds ratio)} of one disease with q < alpha, by q
+    i = result.diseases.index(disease_name)
+    selected = np.flatnonzero((result.rows == i) & (result.q_values < alpha))
+    selected = selected[np.argsort(result.q_values[selected], kind="stable")]
+    return {
+        result.features[result.cols[j]]: (
+            float(result.p_values[j]),
+            float(result.q_values[j]),
+            float(result.odds_ratios[j]),
+        )
+        for j in selected
+    }
+
+
+def count_significant(result, alpha=0.05):
+    # number of features with q < alpha per disease
+    return np.bincount(
+        result.rows[result.q_values < alpha], minlength=len(result.diseases)
+    )
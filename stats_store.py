@@ -0,0 +1,74 @@
+import json
+import os
+from queries import run_query
+
+
+STATS_FILE = "./graph_stats.json"
+
+
+class StatsStore:
+    # Node counts and relationship statistics of earlier runs, stored with
+    # the fingerprint (count and max internal id) of the labels and
+    # relationship types they were computed from. A stored value is reused as
+    # long as its fingerprint has not changed. The fingerprints, and the
+    # stats stored by get_all_node_counts / get_all_rel_min_max_avg, are read
+    # through driver, which must not be a QueryCache: its own fingerprint only
+    # covers counts and would serve stale results after a reload.
+    def __init__(self, driver, path=STATS_FILE):
+        self.driver = driver
+        self.path = path
+        self.data = {"nodes": {}, "relationships": {}}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.data = json.load(f)
+        self._label_fingerprints = {}
+        self._rel_fingerprints = {}
+
+    def get_label_fingerprint(self, label):
+        if label not in self._label_fingerprints:
+            result = run_query(self.driver, "label_fingerprint", label=label)
+            self._label_fingerprints[label] = [result[0]["count"], result[0]["max_id"]]
+        return self._label_fingerprints[label]
+
+    def get_rel_type_fingerprint(self, rel):
+        if rel not in self._rel_fingerprints:
+            result = run_query(self.driver, "rel_type_fingerprint", rel=rel)
+            self._rel_fingerprints[rel] = [result[0]["count"], result[0]["max_id"]]
+        return self._rel_fingerprints[rel]
+
+    def get_triple_fingerprint(self, triple):
+        start, rel, end = triple
+        return [
+            self.get_label_fingerprint(start),
+            self.get_rel_type_fingerprint(rel),
+            self.get_label_fingerprint(end),
+        ]
+
+    def _get(self, section, key, fingerprint):
+        entry = self.data[section].get(key)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return None
+        return entry["value"]
+
+    def _put(self, section, key, fingerprint, value):
+        self.data[section][key] = {"fingerprint": fingerprint, "value": value}
+
+    def get_node_count(self, label, use_wccComponent=False):
+        fingerprint = self.get_label_fingerprint(label)
+        return self._get("nodes", f"{label}|{use_wccComponent}", fingerprint)
+
+    def put_node_count(self, label, count, use_wccComponent=False):
+        fingerprint = self.get_label_fingerprint(label)
+        self._put("nodes", f"{label}|{use_wccComponent}", fingerprint, count)
+
+    def get_rel_stats(self, triple, use_wccComponent=False):
+        fingerprint = self.get_triple_fingerprint(triple)
+        return self._get("relationships", "|".join(triple) + f"|{use_wccComponent}", fingerprint)
+
+    def put_rel_stats(self, triple, stats, use_wccComponent=False):
+        fingerprint = self.get_triple_fingerprint(triple)
+        self._put("relationships", "|".join(triple) + f"|{use_wccComponent}", fingerprint, stats)
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.data, f, indent=2)
@@ -0,0 +1,117 @@
+import os
+import numpy as np
+from graph_snapshot import SAMPLE_LABEL, save_nodes, save_edges, save_meta
+
+
+SYNTHETIC_FOLDER = "./synthetic_graph"
+# (relationship, node type, number of nodes, mean degree per sample) at 10k samples
+SYNTHETIC_FEATURES = [
+    ("HAS_PHENOTYPE", "Phenotype", 2000, 8),
+    ("HAS_PROTEIN", "Protein", 5000, 40),
+    ("HAS_DAMAGE", "Gene", 5000, 20),
+]
+
+
+def get_popularity(count, skew, rng):
+    # Zipf-like weights in random order, skew 0 is uniform
+    weights = 1.0 / np.arange(1, count + 1) ** skew
+    return rng.permutation(weights / weights.sum())
+
+
+def get_degrees(samples, mean, skew, rng):
+    # lognormal degrees with the given mean, skew is the sigma of the log
+    sigma = max(skew, 1e-9)
+    degrees = rng.lognormal(np.log(mean) - sigma**2 / 2, sigma, samples)
+    return np.round(degrees).astype(np.int64)
+
+
+def generate_disease_edges(samples, diseases, skew, control_fraction, comorbidity, undiagnosed, rng):
+    # disease 0 is "control"; every other sample gets one disease, some a second
+    popularity = get_popularity(diseases - 1, skew, rng)
+    kind = rng.random(samples)
+    sick = np.flatnonzero(kind >= control_fraction + undiagnosed)
+    control = np.flatnonzero(kind < control_fraction)
+    first = rng.choice(diseases - 1, size=len(sick), p=popularity) + 1
+    second_samples = sick[rng.random(len(sick)) < comorbidity]
+    second = rng.choice(diseases - 1, size=len(second_samples), p=popularity) + 1
+    edge_samples = np.concatenate([control, sick, second_samples])
+    edge_diseases = np.concatenate([np.zeros(len(control), dtype=np.int64), first, second])
+    return edge_samples, edge_diseases
+
+
+def generate_feature_edges(samples, nodes, mean_degree, skew, disease_of_sample, diseases, signal, rng):
+    # A fraction signal of the edges of a sick sample goes to a handful of
+    # nodes specific to its (first) disease, so comparisons have something
+    # to find; the rest follows the global popularity.
+    degrees = get_degrees(samples, mean_degree, skew, rng)
+    edge_samples = np.repeat(np.arange(samples), degrees)
+    edge_nodes = rng.choice(nodes, size=len(edge_samples), p=get_popularity(nodes, skew, rng))
+    preferred = rng.integers(0, nodes, size=(diseases, 5))
+    edge_diseases = disease_of_sample[edge_samples]
+    enriched = (edge_diseases > 0) & (rng.random(len(edge_samples)) < signal)
+    edge_nodes[enriched] = preferred[
+        edge_diseases[enriched], rng.integers(0, 5, size=int(enriched.sum()))
+    ]
+    return edge_samples, edge_nodes
+
+
+def generate_snapshot(
+    path=SYNTHETIC_FOLDER,
+    samples=10000,
+    diseases=200,
+    features=SYNTHETIC_FEATURES,
+    skew=1.0,
+    control_fraction=0.2,
+    comorbidity=0.1,
+    undiagnosed=0.02,
+    signal=0.1,
+    seed=0,
+):
+    # Writes a graph_snapshot.GraphSnapshot of a random patient graph. Node
+    # counts of the features scale with samples / 10000; skew controls both
+    # how unevenly diseases and features are used and the spread of degrees.
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    scale = samples / 10000
+    next_id = 0
+
+    def add_nodes(label, count, prefix):
+        nonlocal next_id
+        ids = np.arange(next_id, next_id + count, dtype=np.int64)
+        next_id += count
+        save_nodes(path, label, ids, [f"{prefix}_{i}" for i in range(count)])
+
+    add_nodes(SAMPLE_LABEL, samples, "sample")
+    disease_samples, disease_nodes = generate_disease_edges(
+        samples, diseases, skew, control_fraction, comorbidity, undiagnosed, rng
+    )
+    save_nodes(
+        path,
+        "Disease",
+        np.arange(next_id, next_id + diseases, dtype=np.int64),
+        ["control"] + [f"disease_{i}" for i in range(1, diseases)],
+    )
+    next_id += diseases
+    save_edges(path, "HAS_DISEASE", disease_samples, disease_nodes, samples)
+    disease_of_sample = np.full(samples, -1, dtype=np.int64)
+    # later edges are the second diseases, the first write per sample wins
+    disease_of_sample[disease_samples[::-1]] = disease_nodes[::-1]
+
+    connections = [("HAS_DISEASE", "Disease")]
+    for rel, label, count, mean_degree in features:
+        count = max(int(count * scale), 10)
+        add_nodes(label, count, label.lower())
+        edge_samples, edge_nodes = generate_feature_edges(
+            samples, count, mean_degree, skew, disease_of_sample, diseases, signal, rng
+        )
+        save_edges(path, rel, edge_samples, edge_nodes, samples)
+        connections.append((rel, label))
+
+    subjects = max(int(samples / 1.2), 1)
+    add_nodes("Subject", subjects, "subject")
+    save_edges(
+        path, "BELONGS_TO_SUBJECT", np.arange(samples), rng.integers(0, subjects, samples), samples
+    )
+    connections.append(("BELONGS_TO_SUBJECT", "Subject"))
+    save_meta(path, connections)
+    return path
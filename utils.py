@@ -1,4 +1,8 @@
+import atexit
+import json
 import os
+import threading
+import numpy as np
 
 
 #   NEO4J_URI: bolt://172.25.0.1:7687
@@ -16,26 +20,169 @@ NEO4J_DATABASE = "graphdb2"
 
 
 LOG_FILE = "./log.txt"
+LOG_JSON_FILE = "./log.jsonl"
+LOG_FLUSH_EVERY = 1000
 
 FEATURES_FOLDER = "./patient_features"
 percentage_sections = [-1,-0.75, -0.5, -0.25, -0.1, 0, 0.1, 0.25, 0.5, 0.75, 1]
+feature_connections = [
+    ("HAS_PHENOTYPE", "Phenotype"),
+    ("HAS_DAMAGE", "Gene"),
+    ("HAS_PROTEIN", "Protein"),
+]
+
+
+
+class LogSink:
+    # Keeps the log files open and writes them in batches. Every message goes
+    # to the human readable log (if enabled); messages with a key are also
+    # written as JSON lines {"section", "key", "value"} to the structured log,
+    # plus "type" when a record_type is given.
+    def __init__(
+        self,
+        path=LOG_FILE,
+        json_path=LOG_JSON_FILE,
+        flush_every=LOG_FLUSH_EVERY,
+        echo=True,
+        human_readable=True,
+        structured=True,
+    ):
+        self.path = path
+        self.json_path = json_path
+        self.flush_every = flush_every
+        self.echo = echo
+        self.human_readable = human_readable
+        self.structured = structured
+        self.section = None
+        self._lines = []
+        self._records = []
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _get_file(self, path):
+        if path not in self._files:
+            self._files[path] = open(path, "a")
+        return self._files[path]
+
+    def write(self, message, key=None, value=None, record_type=None):
+        if self.echo:
+            print(message)
+        with self._lock:
+            if self.human_readable:
+                self._lines.append(message)
+            if self.structured and key is not None:
+                record = {"section": self.section, "key": key, "value": value}
+                if record_type is not None:
+                    # lets readers pick records without relying on the key
+                    record["type"] = record_type
+                self._records.append(json.dumps(record, default=str) + "\n")
+            if len(self._lines) + len(self._records) >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        for path, buffer in ((self.path, self._lines), (self.json_path, self._records)):
+            if buffer:
+                f = self._get_file(path)
+                f.write("".join(buffer))
+                f.flush()
+        self._lines = []
+        self._records = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+    def clear(self):
+        with self._lock:
+            self._lines = []
+            self._records = []
+            for path in (self.path, self.json_path):
+                if path in self._files:
+                    self._files.pop(path).close()
+                self._files[path] = open(path, "w")
+
+
+log_sink = LogSink()
+atexit.register(log_sink.close)
+
+
+def configure_log(**options):
+    # e.g. configure_log(echo=False, human_readable=False)
+    log_sink.flush()
+    for name, value in options.items():
+        setattr(log_sink, name, value)
+
+
+def log_to_file(message, key=None, value=None, record_type=None):
+    log_sink.write(message, key, value, record_type)
+
+
+def log_section(title):
+    log_sink.section = title
+    log_to_file("\n")
+    log_to_file(f"------------------------- {title} -------------------------\n")
 
 
-
-def log_to_file(message):
-    print(message)
-    with open(LOG_FILE, "a") as f:
-        f.write(message)
-
 def clear_log_file():
-    with open(LOG_FILE, "w") as f:
-        f.write("")
+    log_sink.clear()
 
 
-def request(driver, query):
+def request(driver, query, parameters=None):
+    # driver is either a neo4j driver or anything with a run(query, parameters)
+    # method, e.g. session_manager.SessionManager
+    if hasattr(driver, "run"):
+        return driver.run(query, parameters)
     with driver.session(database=NEO4J_DATABASE) as session:
-        result = session.run(query).data()
+        result = session.run(query, parameters).data()
         return result
+
+
+def request_with_summary(driver, query, parameters=None):
+    # Like request, but also returns the neo4j ResultSummary (plan, profile,
+    # timings). Never served from a cache.
+    if hasattr(driver, "run_with_summary"):
+        return driver.run_with_summary(query, parameters)
+    with driver.session(database=NEO4J_DATABASE) as session:
+        result = session.run(query, parameters)
+        data = result.data()
+        return data, result.consume()
+
+
+def stream_request(driver, query, parameters=None, fetch_size=None):
+    # Yields the records one by one as dicts while the server streams them,
+    # fetch_size records per round trip, instead of building the whole list.
+    if hasattr(driver, "stream"):
+        yield from driver.stream(query, parameters, fetch_size)
+        return
+    session_args = {"database": NEO4J_DATABASE}
+    if fetch_size:
+        session_args["fetch_size"] = fetch_size
+    with driver.session(**session_args) as session:
+        for record in session.run(query, parameters):
+            yield record.data()
+
+
+def stream_column_batches(driver, query, parameters=None, batch_size=10000, fetch_size=None):
+    # Yields dicts of column name -> numpy array with up to batch_size rows.
+    rows = []
+    for row in stream_request(driver, query, parameters, fetch_size):
+        rows.append(row)
+        if len(rows) >= batch_size:
+            yield rows_to_columns(rows)
+            rows = []
+    if rows:
+        yield rows_to_columns(rows)
+
+
+def rows_to_columns(rows):
+    return {key: np.asarray([row[key] for row in rows]) for key in rows[0]}
     
 def get_disease_folder_name(disease_name):
     return f"{FEATURES_FOLDER}/{disease_name}"